@@ -1,18 +1,63 @@
+import os
+
 from celery import Celery
 from celery.schedules import crontab
+from celery.signals import worker_process_init, worker_process_shutdown
+
+from app.db.engine import SessionLocal
+from app.db.event_filter import get_event_id_filter, warm_event_id_filter
+from app.tasks import create_events_task, RESULT_TTL_SECONDS
 
-from app.tasks import create_events_task
 
+ANALYTICS_SYNC_SECONDS = float(os.getenv("ANALYTICS_SYNC_SECONDS", 15))
+ANALYTICS_PUBLISH_SECONDS = float(os.getenv("ANALYTICS_PUBLISH_SECONDS", 300))
 
 celery_app = Celery(
     "events_service", broker="redis://redis:6379", backend="redis://redis:6379"
 )
 
+celery_app.conf.task_track_started = True
+celery_app.conf.result_expires = RESULT_TTL_SECONDS
+
 celery_app.conf.beat_schedule = {
-    "sync-duckdb-every-minute": {
+    "sync-duckdb": {
         "task": "app.tasks.sync_events_to_duck",
+        "schedule": ANALYTICS_SYNC_SECONDS,
+    },
+    "publish-duckdb-snapshots": {
+        "task": "app.tasks.publish_analytics_snapshots",
+        "schedule": ANALYTICS_PUBLISH_SECONDS,
+    },
+    "redeliver-ingest-log-every-minute": {
+        "task": "app.tasks.redeliver_ingest_log",
         "schedule": crontab(minute="*/1"),
     },
+    "prepare-realtime-counters-hourly": {
+        "task": "app.tasks.prepare_realtime_counters",
+        "schedule": crontab(minute=30),
+    },
+    "archive-old-events-daily": {
+        "task": "app.tasks.archive_old_events",
+        "schedule": crontab(hour=3, minute=0),
+    },
 }
 
 celery_app.autodiscover_tasks(packages=["app"])
+
+
+@worker_process_init.connect
+def load_event_id_filter(**kwargs):
+    """
+    Load the persisted event_id filter, or rebuild it from the database.
+    """
+
+    db = SessionLocal()
+    try:
+        warm_event_id_filter(db)
+    finally:
+        db.close()
+
+
+@worker_process_shutdown.connect
+def save_event_id_filter(**kwargs):
+    get_event_id_filter().save()
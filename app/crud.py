@@ -1,28 +1,111 @@
-from datetime import date, datetime, time, timedelta
+from datetime import date, datetime, time, timedelta, timezone, tzinfo
 
 from typing import Dict, List, Optional
 from sqlalchemy.orm import Session
 from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 
 from app.db import models
-from app.db.duck import query_analytics
+from app.db.archive import find_archived_event_ids
+from app.db.bulk import bulk_insert_events
+from app.db.duck import query_shards
+from app.db.event_filter import EventIdFilter, get_event_id_filter
 import app.schemas as schemas
 
 
-def create_events(db: Session, events: List[schemas.EventCreate]):
-    created = []
+EXISTS_CHUNK_SIZE = 500
+
+
+def _existing_event_ids(db: Session, event_ids: List) -> set:
+    existing = set()
+    for i in range(0, len(event_ids), EXISTS_CHUNK_SIZE):
+        chunk = event_ids[i : i + EXISTS_CHUNK_SIZE]
+        rows = db.query(models.Event.event_id).filter(models.Event.event_id.in_(chunk))
+        existing.update(r.event_id for r in rows)
+    return existing
+
+
+def create_events(
+    db: Session,
+    events: List[schemas.EventCreate],
+    id_filter: Optional[EventIdFilter] = None,
+):
+    """
+    Insert events, skipping ones whose event_id is already stored.
+
+    IDs the Bloom filter has definitely not seen skip the existence check;
+    only probable duplicates are verified, with one IN query per chunk.
+    IDs that aged out of the filter are caught by the primary key, in which
+    case the batch is retried with every ID verified. IDs moved to the
+    archive are checked the same way against the archive filter.
+    """
+
+    if id_filter is None:
+        id_filter = get_event_id_filter()
+
+    unique, seen = [], set()
     for e in events:
-        exists = (
-            db.query(models.Event).filter(models.Event.event_id == e.event_id).first()
+        if e.event_id not in seen:
+            seen.add(e.event_id)
+            unique.append(e)
+    event_ids = [e.event_id for e in unique]
+
+    probable = [
+        event_id
+        for event_id, maybe_seen in zip(
+            event_ids, id_filter.might_contain_many(event_ids)
         )
-        if not exists:
-            event = models.Event(**e.model_dump())
-            db.add(event)
-            created.append(event)
+        if maybe_seen
+    ]
+
+    existing = _existing_event_ids(db, probable)
+    existing |= find_archived_event_ids([i for i in event_ids if i not in existing])
+
+    try:
+        created = _insert_new_events(db, unique, existing)
+    except IntegrityError:
+        db.rollback()
+        existing |= _existing_event_ids(db, event_ids)
+        created = _insert_new_events(db, unique, existing)
+
+    id_filter.add_many(event_ids)
+    return created
+
+
+def _insert_new_events(db: Session, events: List[schemas.EventCreate], existing: set):
+    created = [e for e in events if e.event_id not in existing]
+    bulk_insert_events(db, [e.model_dump() for e in created])
     db.commit()
     return created
 
 
+def _apply_filters(query, filter_params: Optional[Dict]):
+    if filter_params:
+        if "event_type" in filter_params:
+            query = query.filter(models.Event.event_type == filter_params["event_type"])
+        if "properties" in filter_params:
+            for key, value in filter_params["properties"].items():
+                query = query.filter(models.Event.properties[key].as_string() == value)
+    return query
+
+
+def _duck_filters(filter_params: Optional[Dict]):
+    sql, params = "", []
+
+    if filter_params:
+        if "event_type" in filter_params:
+            sql += " AND event_type = ?"
+            params.append(filter_params["event_type"])
+
+        if "properties" in filter_params:
+            for key, value in filter_params["properties"].items():
+                sql += " AND json_extract_string(properties, ?) = ?"
+                params.append(f"$.{key}")
+                params.append(value)
+
+    return sql, params
+
+
 def get_dau(db: Session, from_date: date, to_date: date, filter_params=None):
     from_dt = datetime.combine(from_date, time.min)
     to_dt = datetime.combine(to_date, time.max)
@@ -35,22 +118,18 @@ def get_dau(db: Session, from_date: date, to_date: date, filter_params=None):
         models.Event.occurred_at <= to_dt,
     )
 
-    if filter_params:
-        if "event_type" in filter_params:
-            query = query.filter(models.Event.event_type == filter_params["event_type"])
-        if "properties" in filter_params:
-            for key, value in filter_params["properties"].items():
-                query = query.filter(models.Event.properties[key].astext == value)
-
+    query = _apply_filters(query, filter_params)
     query = query.group_by(func.date(models.Event.occurred_at)).order_by("date")
     result = query.all()
     return [{"date": r.date, "dau": r.dau} for r in result]
 
 
-def get_dau_duck(from_: date, to: date, filter_params: Optional[Dict]) -> List[Dict]:
+def get_dau_duck(from_: date, to: date, filter_params: Optional[Dict]) -> List[tuple]:
     """
-    Get Daily Active Users from DuckDB.
+    Get Daily Active Users from DuckDB as (day, dau) rows.
     Note: No SQLAlchemy db parameter needed for DuckDB queries.
+
+    Shards hold disjoint users, so their daily counts are summed.
     """
     sql = """
         SELECT CAST(occurred_at AS DATE) AS day,
@@ -59,24 +138,85 @@ def get_dau_duck(from_: date, to: date, filter_params: Optional[Dict]) -> List[D
         WHERE CAST(occurred_at AS DATE) BETWEEN ? AND ?
     """
 
-    params = [from_, to]
+    filter_sql, filter_params = _duck_filters(filter_params)
+    sql += filter_sql + " GROUP BY day;"
 
-    if filter_params:
-        if "event_type" in filter_params:
-            sql += " AND event_type = ?"
-            params.append(filter_params["event_type"])
+    counts: Dict[date, int] = {}
+    for rows in query_shards(sql, [from_, to] + filter_params):
+        for day, dau in rows:
+            counts[day] = counts.get(day, 0) + dau
+    return sorted(counts.items())
 
-        if "properties" in filter_params:
-            for key, value in filter_params["properties"].items():
-                sql += " AND json_extract(properties, ?) = ?"
-                params.append(f"$.{key}")
-                params.append(value)
 
-    sql += " GROUP BY day ORDER BY day;"
+def get_export_sql(
+    from_: date, to: date, filter_params: Optional[Dict], as_json: bool = False
+):
+    """
+    Build the DuckDB query selecting raw events for an export.
+    With `as_json`, each row is rendered by DuckDB as one JSON object string.
+    """
+    columns = "event_id, user_id, occurred_at, event_type, properties"
+    if as_json:
+        columns = f"to_json(struct_pack({columns}))::VARCHAR AS line"
 
-    rows = query_analytics(sql, params)
+    sql = f"""
+        SELECT {columns}
+        FROM events
+        WHERE occurred_at >= ? AND occurred_at < ?
+    """
 
-    return [{"day": row[0], "count": row[1]} for row in rows]
+    filter_sql, filter_params = _duck_filters(filter_params)
+    params = [
+        datetime.combine(from_, time.min),
+        datetime.combine(to + timedelta(days=1), time.min),
+    ]
+
+    return sql + filter_sql, params + filter_params
+
+
+def get_day_users_duck(day: date, filter_params: Optional[Dict]) -> set:
+    """
+    Get the distinct user_ids active on one day from DuckDB.
+    Used to merge a partially synced day with the OLTP tail.
+    """
+    sql = """
+        SELECT DISTINCT user_id
+        FROM events
+        WHERE CAST(occurred_at AS DATE) = ?
+    """
+
+    filter_sql, filter_params = _duck_filters(filter_params)
+    shards = query_shards(sql + filter_sql, [day] + filter_params)
+
+    return {int(r[0]) for rows in shards for r in rows}
+
+
+def get_tail_day_users(
+    db: Session,
+    after: Optional[datetime],
+    from_date: date,
+    to_date: date,
+    filter_params=None,
+) -> Dict[date, set]:
+    """
+    Get distinct (day, user_id) pairs from the OLTP store for events that
+    occurred after `after`, i.e. the part not yet synced to DuckDB.
+    """
+    from_dt = datetime.combine(from_date, time.min)
+    to_dt = datetime.combine(to_date, time.max)
+
+    query = db.query(
+        func.date(models.Event.occurred_at).label("date"), models.Event.user_id
+    ).filter(models.Event.occurred_at >= from_dt, models.Event.occurred_at <= to_dt)
+    if after is not None:
+        query = query.filter(models.Event.occurred_at > after)
+
+    query = _apply_filters(query, filter_params).distinct()
+
+    days: Dict[date, set] = {}
+    for r in query:
+        days.setdefault(date.fromisoformat(str(r.date)), set()).add(r.user_id)
+    return days
 
 
 def get_top_events(db: Session, from_date: date, to_date: date, limit: int = 10):
@@ -96,17 +236,170 @@ def get_top_events(db: Session, from_date: date, to_date: date, limit: int = 10)
     return [{"event_type": r.event_type, "count": r.count} for r in result]
 
 
-def get_top_events_duck(from_: date, to: date, limit: int = 10):
+def get_top_events_duck(
+    from_: date,
+    to: date,
+    limit: Optional[int] = 10,
+    until: Optional[datetime] = None,
+):
+    """
+    Get (event_type, count) rows from DuckDB, most frequent first.
+    With `until`, only events that occurred up to it are counted.
+
+    Counts are summed across shards before the limit is applied.
+    """
     sql = """
         SELECT event_type, COUNT(*) AS cnt
         FROM events
         WHERE CAST(occurred_at AS DATE) BETWEEN ? AND ?
+    """
+    params = [from_, to]
+    if until is not None:
+        sql += " AND occurred_at <= ?"
+        params.append(until)
+    sql += " GROUP BY event_type"
+
+    counts: Dict[str, int] = {}
+    for rows in query_shards(sql, params):
+        for event_type, count in rows:
+            counts[event_type] = counts.get(event_type, 0) + count
+
+    top = sorted(counts.items(), key=lambda item: item[1], reverse=True)
+    return top if limit is None else top[:limit]
+
+
+def get_tail_event_counts(
+    db: Session, after: Optional[datetime], from_date: date, to_date: date
+) -> Dict[str, int]:
+    """
+    Count events per type in the OLTP store that occurred after `after`.
+    """
+    from_dt = datetime.combine(from_date, time.min)
+    to_dt = datetime.combine(to_date, time.max)
+
+    query = db.query(
+        models.Event.event_type, func.count(models.Event.event_id).label("count")
+    ).filter(models.Event.occurred_at >= from_dt, models.Event.occurred_at <= to_dt)
+    if after is not None:
+        query = query.filter(models.Event.occurred_at > after)
+
+    return {r.event_type: r.count for r in query.group_by(models.Event.event_type)}
+
+
+def get_dau_hourly(hours: List[datetime], days: List[date]) -> Dict[date, int]:
+    """
+    Get Daily Active Users from the hourly rollups, with each UTC hour in
+    `hours` assigned to the local day at the same position in `days`.
+    """
+    sql = """
+        SELECT m.day, COUNT(DISTINCT u.user_id) AS dau
+        FROM user_hours u
+        JOIN (SELECT UNNEST(?::TIMESTAMP[]) AS hour, UNNEST(?::DATE[]) AS day) m
+            USING (hour)
+        GROUP BY m.day
+    """
+
+    counts: Dict[date, int] = {}
+    for rows in query_shards(sql, [hours, days]):
+        for day, dau in rows:
+            counts[day] = counts.get(day, 0) + dau
+    return counts
+
+
+def get_users_hourly(start: datetime, end: datetime) -> set:
+    """
+    Get the distinct user_ids active in the UTC hours [start, end)
+    from the hourly rollups.
+    """
+    sql = "SELECT DISTINCT user_id FROM user_hours WHERE hour >= ? AND hour < ?"
+    shards = query_shards(sql, [start, end])
+
+    return {int(r[0]) for rows in shards for r in rows}
+
+
+def get_event_counts_hourly(
+    start: datetime, end: datetime, until: datetime
+) -> Dict[str, int]:
+    """
+    Count events per type that occurred in [start, end) and up to `until`.
+
+    Whole hours come from the hourly rollups; the hour `until` falls in
+    is only partly synced on lagging shards, so it is counted from raw
+    events.
+    """
+    cutoff = min(end, until)
+    last_hour = cutoff.replace(minute=0, second=0, microsecond=0)
+
+    sql = """
+        SELECT event_type, SUM(events)
+        FROM events_hourly
+        WHERE hour >= ? AND hour < ?
         GROUP BY event_type
-        ORDER BY cnt DESC
-        LIMIT ?;
     """
-    rows = query_analytics(sql, [from_, to, limit])
-    return [{"event_type": r[0], "count": r[1]} for r in rows]
+    shards = query_shards(sql, [start, last_hour])
+    if last_hour < cutoff:
+        sql = """
+            SELECT event_type, COUNT(*)
+            FROM events
+            WHERE occurred_at >= ? AND occurred_at <= ? AND occurred_at < ?
+            GROUP BY event_type
+        """
+        shards += query_shards(sql, [last_hour, until, end])
+
+    counts: Dict[str, int] = {}
+    for rows in shards:
+        for event_type, count in rows:
+            counts[event_type] = counts.get(event_type, 0) + int(count)
+    return counts
+
+
+def _naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def get_local_day_users(
+    db: Session,
+    after: Optional[datetime],
+    bounds: Dict[date, tuple],
+    tz: tzinfo,
+) -> Dict[date, set]:
+    """
+    Get distinct user_ids per local day from the OLTP store, for events
+    that occurred after `after` (all events if None). `bounds` maps each
+    local day to its [start, end) in UTC, as built by local_day_bounds.
+    """
+    start = min(b[0] for b in bounds.values())
+    end = max(b[1] for b in bounds.values())
+
+    query = db.query(models.Event.occurred_at, models.Event.user_id).filter(
+        models.Event.occurred_at >= start, models.Event.occurred_at < end
+    )
+    if after is not None:
+        query = query.filter(models.Event.occurred_at > after)
+
+    days: Dict[date, set] = {}
+    for r in query.distinct():
+        occurred_at = _naive_utc(r.occurred_at).replace(tzinfo=timezone.utc)
+        days.setdefault(occurred_at.astimezone(tz).date(), set()).add(r.user_id)
+    return days
+
+
+def get_event_counts_between(
+    db: Session, after: Optional[datetime], start: datetime, end: datetime
+) -> Dict[str, int]:
+    """
+    Count events per type in the OLTP store that occurred in [start, end)
+    and after `after` (all of them if None).
+    """
+    query = db.query(
+        models.Event.event_type, func.count(models.Event.event_id).label("count")
+    ).filter(models.Event.occurred_at >= start, models.Event.occurred_at < end)
+    if after is not None:
+        query = query.filter(models.Event.occurred_at > after)
+
+    return {r.event_type: r.count for r in query.group_by(models.Event.event_type)}
 
 
 def get_retention(db: Session, start_date: date, windows: int = 3):
@@ -124,21 +417,3 @@ def get_retention(db: Session, start_date: date, windows: int = 3):
         )
         cohorts.append({"window": i + 1, "active_users": active_users})
     return cohorts
-
-
-def get_retention_duck(start_date: date, windows: int = 3):
-    sql = """
-        SELECT win, COUNT(DISTINCT user_id) AS active_users
-        FROM (
-            SELECT 
-                user_id,
-                CAST(julian(CAST(occurred_at AS DATE)) - julian(CAST(? AS DATE)) AS INT) AS win
-            FROM events
-        )
-        WHERE win >= 0 AND win < ?
-        GROUP BY win
-        ORDER BY win;
-    """
-
-    rows = query_analytics(sql, [start_date, windows])
-    return [{"window": r[0] + 1, "active_users": r[1]} for r in rows]
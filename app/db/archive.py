@@ -0,0 +1,328 @@
+import json
+import os
+from datetime import date, datetime, time, timedelta, timezone
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import duckdb
+import pyarrow as pa
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from app.db import models
+from app.db.duck import get_sync_watermark, query_shards
+from app.db.event_filter import EventIdFilter
+from app.logger import logger
+
+
+BASE_DIR = Path(__file__).resolve().parents[2]
+ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", BASE_DIR / "archive"))
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 90))
+ARCHIVE_FILTER_CAPACITY = int(os.getenv("ARCHIVE_FILTER_CAPACITY", 10_000_000))
+DELETE_CHUNK_SIZE = 500
+ARCHIVE_BATCH_SIZE = 50_000
+FILTER_REBUILD_BATCH_SIZE = 100_000
+
+_archive_filter: Optional[EventIdFilter] = None
+_archive_filter_mtime: Optional[int] = None
+
+
+def _naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _filter_mtime(path: Path) -> Optional[int]:
+    try:
+        return path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def get_archive_filter() -> EventIdFilter:
+    """
+    Return the filter over every archived event_id.
+
+    Unlike the hot filter it never rotates: a miss must mean the ID was
+    never archived, or an archived event could be ingested twice. The
+    archive is written by whichever worker runs archive_old_events, so the
+    file is reloaded whenever its mtime changes, and rebuilt from the
+    Parquet files if it is missing or was built with other settings.
+    """
+
+    global _archive_filter, _archive_filter_mtime
+
+    path = ARCHIVE_DIR / "event_ids.bloom"
+    mtime = _filter_mtime(path)
+    if _archive_filter is not None and mtime == _archive_filter_mtime:
+        return _archive_filter
+
+    archive_filter = EventIdFilter(
+        capacity=ARCHIVE_FILTER_CAPACITY,
+        redis_url=None,
+        path=path,
+        rotating=False,
+    )
+    if not archive_filter.load() and _rebuild_archive_filter(archive_filter):
+        mtime = _filter_mtime(path)
+
+    _archive_filter, _archive_filter_mtime = archive_filter, mtime
+    return archive_filter
+
+
+def _rebuild_archive_filter(archive_filter: EventIdFilter) -> bool:
+    """
+    Refill the archive filter from the event_ids in the Parquet files.
+    Returns False if there is nothing archived yet.
+    """
+
+    if not any(ARCHIVE_DIR.glob("events_*.parquet")):
+        return False
+
+    logger.warning("Archive filter is missing or stale, rebuilding from archive")
+    conn = duckdb.connect()
+    try:
+        result = conn.execute(
+            "SELECT event_id FROM read_parquet(?)",
+            [str(ARCHIVE_DIR / "events_*.parquet")],
+        )
+        while rows := result.fetchmany(FILTER_REBUILD_BATCH_SIZE):
+            archive_filter.add_many(r[0] for r in rows)
+    finally:
+        conn.close()
+
+    archive_filter.save()
+    return True
+
+
+def find_archived_event_ids(event_ids: List) -> set:
+    """
+    Return the subset of `event_ids` present in the archive files.
+    Only IDs the archive filter reports as probably archived are looked up.
+    """
+
+    if not event_ids:
+        return set()
+
+    archive_filter = get_archive_filter()
+
+    candidates = [
+        str(event_id)
+        for event_id, seen in zip(
+            event_ids, archive_filter.might_contain_many(event_ids)
+        )
+        if seen
+    ]
+    if not candidates:
+        return set()
+
+    conn = duckdb.connect()
+    try:
+        rows = conn.execute(
+            "SELECT event_id FROM read_parquet(?) WHERE event_id IN "
+            "(SELECT UNNEST(CAST(? AS UUID[])))",
+            [str(ARCHIVE_DIR / "events_*.parquet"), candidates],
+        ).fetchall()
+    finally:
+        conn.close()
+
+    return {r[0] for r in rows}
+
+
+def _stage_events(conn, db: Session, start: datetime, end: datetime) -> Tuple[int, int]:
+    """
+    Stream the events in [start, end) from the OLTP store into the `batch`
+    table of a scratch DuckDB connection, ARCHIVE_BATCH_SIZE rows at a
+    time through Arrow. Returns how many were staged and how many of them
+    are missing from the analytics store.
+    """
+
+    conn.execute(
+        """
+        CREATE TABLE batch (
+            event_id UUID,
+            occurred_at TIMESTAMP,
+            user_id INTEGER,
+            event_type TEXT,
+            properties JSON
+        )
+    """
+    )
+
+    result = db.execute(
+        select(
+            models.Event.event_id,
+            models.Event.occurred_at,
+            models.Event.user_id,
+            models.Event.event_type,
+            models.Event.properties,
+        )
+        .where(models.Event.occurred_at >= start, models.Event.occurred_at < end)
+        .execution_options(yield_per=ARCHIVE_BATCH_SIZE)
+    )
+
+    staged = missing = 0
+    for rows in result.partitions():
+        event_ids = [str(row.event_id) for row in rows]
+        chunk = pa.table(
+            {
+                "event_id": event_ids,
+                "occurred_at": pa.array(
+                    [_naive_utc(row.occurred_at) for row in rows], pa.timestamp("us")
+                ),
+                "user_id": pa.array([row.user_id for row in rows], pa.int32()),
+                "event_type": pa.array([row.event_type for row in rows], pa.string()),
+                "properties": pa.array(
+                    [
+                        json.dumps(row.properties) if row.properties else None
+                        for row in rows
+                    ],
+                    pa.string(),
+                ),
+            }
+        )
+        conn.register("chunk", chunk)
+        conn.execute(
+            """
+            INSERT INTO batch
+            SELECT CAST(event_id AS UUID), occurred_at, user_id, event_type,
+                   CAST(properties AS JSON)
+            FROM chunk
+        """
+        )
+        conn.unregister("chunk")
+
+        staged += len(rows)
+        missing += _missing_from_analytics(event_ids)
+
+    return staged, missing
+
+
+def _staged_event_ids(conn) -> Iterator[list]:
+    result = conn.execute("SELECT event_id FROM batch")
+    while rows := result.fetchmany(ARCHIVE_BATCH_SIZE):
+        yield [r[0] for r in rows]
+
+
+def _write_parquet(conn, path: Path):
+    """
+    Write the staged events to a zstd-compressed Parquet file sorted by
+    event_id, so row-group statistics let lookups skip most of the file.
+    """
+
+    tmp_path = path.with_suffix(".tmp")
+    target = str(tmp_path).replace("'", "''")
+    conn.execute(
+        f"COPY (SELECT * FROM batch ORDER BY event_id) TO '{target}' "
+        "(FORMAT PARQUET, COMPRESSION ZSTD)"
+    )
+    os.replace(tmp_path, path)
+
+
+def _archive_path(day: date) -> Path:
+    path = ARCHIVE_DIR / f"events_{day.isoformat()}.parquet"
+    n = 1
+    while path.exists():
+        path = ARCHIVE_DIR / f"events_{day.isoformat()}_{n}.parquet"
+        n += 1
+    return path
+
+
+def _missing_from_analytics(event_ids: List) -> int:
+    """
+    Count the event_ids not stored in DuckDB. IDs are unique there, so
+    matching rows can be counted across shards.
+    """
+
+    shards = query_shards(
+        "SELECT COUNT(*) FROM events WHERE event_id IN "
+        "(SELECT UNNEST(CAST(? AS UUID[])))",
+        [[str(event_id) for event_id in event_ids]],
+    )
+    return len(event_ids) - sum(rows[0][0] for rows in shards)
+
+
+def archive_events(db: Session, cutoff: datetime) -> int:
+    """
+    Move events that occurred before `cutoff` from the OLTP store into
+    daily Parquet files under ARCHIVE_DIR.
+
+    A day is only archived once DuckDB is synced past it and holds every
+    one of its event_ids. Archived IDs are added to the
+    archive filter before the rows are deleted, so idempotency checks keep
+    working for them.
+
+    Each day is streamed in ARCHIVE_BATCH_SIZE chunks into a scratch
+    DuckDB database that spills to disk, so memory stays bounded however
+    many events a day holds.
+    """
+
+    watermark = get_sync_watermark()
+    if watermark is None:
+        logger.info("Nothing synced to DuckDB yet, skipping archive")
+        return 0
+    cutoff = min(cutoff, watermark)
+
+    oldest = db.query(func.min(models.Event.occurred_at)).scalar()
+    if oldest is None or _naive_utc(oldest) >= cutoff:
+        return 0
+
+    ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+    archive_filter = get_archive_filter()
+    archived = 0
+
+    day = _naive_utc(oldest).date()
+    while day <= cutoff.date():
+        start = datetime.combine(day, time.min)
+        end = min(start + timedelta(days=1), cutoff)
+        day += timedelta(days=1)
+
+        conn = duckdb.connect(config={"temp_directory": str(ARCHIVE_DIR / ".tmp")})
+        try:
+            staged, missing = _stage_events(conn, db, start, end)
+            if not staged:
+                continue
+            if missing:
+                logger.warning(
+                    f"Events for {start.date()} not fully in DuckDB, skipping"
+                )
+                continue
+
+            _write_parquet(conn, _archive_path(start.date()))
+
+            for event_ids in _staged_event_ids(conn):
+                archive_filter.add_many(event_ids)
+            archive_filter.save()
+
+            for event_ids in _staged_event_ids(conn):
+                for i in range(0, len(event_ids), DELETE_CHUNK_SIZE):
+                    db.query(models.Event).filter(
+                        models.Event.event_id.in_(event_ids[i : i + DELETE_CHUNK_SIZE])
+                    ).delete(synchronize_session=False)
+            db.commit()
+            archived += staged
+        finally:
+            conn.close()
+
+    return archived
+
+
+def compact_store(engine):
+    """
+    Reclaim space freed by archiving and refresh planner statistics.
+    """
+
+    if engine.dialect.name == "sqlite":
+        # SQLite connections run in driver-level autocommit (see engine.py),
+        # so VACUUM goes straight to the driver, outside any transaction.
+        raw_conn = engine.raw_connection()
+        try:
+            raw_conn.driver_connection.execute("VACUUM")
+            raw_conn.driver_connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            raw_conn.close()
+        return
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("VACUUM ANALYZE events")
@@ -0,0 +1,62 @@
+import json
+from typing import Dict, List
+
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.db import models
+
+
+EVENT_COLUMNS = ("event_id", "occurred_at", "user_id", "event_type", "properties")
+
+
+def bulk_insert_events(db: Session, rows: List[Dict]):
+    """
+    Write many events in one round trip, without building ORM objects.
+
+    PostgreSQL goes through COPY; other backends use a multi-row INSERT.
+    Rows must already be deduplicated: a conflicting event_id raises
+    IntegrityError and the caller is expected to roll back.
+    """
+
+    if not rows:
+        return
+
+    if db.get_bind().dialect.name == "postgresql":
+        _copy_events(db, rows)
+    else:
+        db.execute(insert(models.Event), rows)
+
+
+def _copy_events(db: Session, rows: List[Dict]):
+    import psycopg
+
+    raw_conn = db.connection().connection.driver_connection
+    sql = f"COPY events ({', '.join(EVENT_COLUMNS)}) FROM STDIN"
+
+    try:
+        with raw_conn.cursor() as cursor:
+            with cursor.copy(sql) as copy:
+                for row in rows:
+                    copy.write_row(_copy_row(row))
+    except psycopg.errors.UniqueViolation as e:
+        raise IntegrityError(sql, None, e) from e
+
+
+def _copy_row(row: Dict) -> tuple:
+    """
+    Build the COPY tuple for one event, in EVENT_COLUMNS order.
+
+    Values are passed as Python objects and escaped by psycopg's COPY
+    writer; properties are sent as JSON text and a missing value as NULL.
+    """
+
+    properties = row["properties"]
+    return (
+        row["event_id"],
+        row["occurred_at"],
+        row["user_id"],
+        row["event_type"],
+        json.dumps(properties) if properties is not None else None,
+    )
@@ -1,35 +1,421 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from datetime import datetime
 from pathlib import Path
-from typing import Any, List
+from typing import Any, List, Optional
 
 import duckdb
 
+from app.profiling import current_profile, phase, render_duck_plan
+
+try:
+    import fcntl
+except ImportError:  # Windows: snapshots are retired by age only
+    fcntl = None
+
 
 BASE_DIR = Path(__file__).resolve().parents[2]
 DUCKDB_PATH = BASE_DIR / "analytics.duckdb"
+SNAPSHOT_DIR = Path(os.getenv("SNAPSHOT_DIR", BASE_DIR / "analytics_snapshots"))
+DUCKDB_QUERY_TIMEOUT = float(os.getenv("DUCKDB_QUERY_TIMEOUT", 10))
+ANALYTICS_SHARDS = int(os.getenv("ANALYTICS_SHARDS", 1))
+ANALYTICS_FANOUT_WORKERS = int(
+    os.getenv("ANALYTICS_FANOUT_WORKERS", os.cpu_count() or 4)
+)
+SNAPSHOT_OPEN_ATTEMPTS = 10
+
+_fanout_pool = ThreadPoolExecutor(
+    max_workers=ANALYTICS_FANOUT_WORKERS, thread_name_prefix="duck-shard"
+)
+
+
+class QueryCancelled(Exception):
+    """
+    Raised when an analytics query is interrupted by a timeout or cancellation.
+    """
+
+
+class ShardCountMismatch(Exception):
+    """
+    Raised when the DuckDB files were laid out for a different
+    ANALYTICS_SHARDS than the one configured. They must be redistributed
+    with `python -m cli.reshard` before they are read or written again.
+    """
+
+
+class QueryScope:
+    """
+    Tracks the DuckDB connections used while serving one request,
+    so all of them can be interrupted when the client goes away.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._conns = set()
+        self._lock = threading.Lock()
+
+    def register(self, conn):
+        with self._lock:
+            if self.cancelled:
+                raise QueryCancelled("Request was cancelled")
+            self._conns.add(conn)
+
+    def unregister(self, conn):
+        with self._lock:
+            self._conns.discard(conn)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for conn in self._conns:
+                conn.interrupt()
+
+
+current_scope: ContextVar[Optional[QueryScope]] = ContextVar(
+    "current_scope", default=None
+)
+
+
+def shard_for(user_id: int) -> int:
+    """
+    Return the analytics shard holding a user's events. Users are spread
+    by a multiplicative hash, so sequential IDs do not cluster.
+    """
+
+    return (int(user_id) * 2654435761) % 2**32 % ANALYTICS_SHARDS
+
+
+def shard_path(shard: int = 0) -> Path:
+    if ANALYTICS_SHARDS == 1:
+        return DUCKDB_PATH
+    return DUCKDB_PATH.with_name(f"{DUCKDB_PATH.stem}_{shard}{DUCKDB_PATH.suffix}")
+
+
+def _snapshot_dir(shard: int) -> Path:
+    if ANALYTICS_SHARDS == 1:
+        return SNAPSHOT_DIR
+    return SNAPSHOT_DIR / f"shard_{shard}"
+
+
+def shard_files() -> List[Path]:
+    """
+    Return every working DuckDB file on disk, whatever ANALYTICS_SHARDS
+    it was written with.
+    """
+
+    pattern = re.compile(rf"{re.escape(DUCKDB_PATH.stem)}_\d+")
+    files = [DUCKDB_PATH] if DUCKDB_PATH.exists() else []
+    files += sorted(
+        path
+        for path in DUCKDB_PATH.parent.glob(f"{DUCKDB_PATH.stem}_*{DUCKDB_PATH.suffix}")
+        if pattern.fullmatch(path.stem)
+    )
+    return files
+
+
+def stray_snapshot_dirs() -> List[Path]:
+    """
+    Return snapshot directories published for a different shard count.
+    """
+
+    if not SNAPSHOT_DIR.exists():
+        return []
+    dirs = [
+        path
+        for path in SNAPSHOT_DIR.glob("shard_*")
+        if (path / "CURRENT").exists()
+        and (ANALYTICS_SHARDS == 1 or int(path.name[6:]) >= ANALYTICS_SHARDS)
+    ]
+    if ANALYTICS_SHARDS > 1 and (SNAPSHOT_DIR / "CURRENT").exists():
+        dirs.append(SNAPSHOT_DIR)
+    return sorted(dirs)
+
+
+def check_shard_files():
+    """
+    Raise ShardCountMismatch if working files of another shard layout
+    exist, e.g. analytics.duckdb after switching to several shards.
+    """
+
+    expected = {shard_path(shard) for shard in range(ANALYTICS_SHARDS)}
+    stray = [path.name for path in shard_files() if path not in expected]
+    if stray:
+        raise ShardCountMismatch(
+            f"DuckDB files {stray} belong to another ANALYTICS_SHARDS setting; "
+            "run python -m cli.reshard"
+        )
+
+
+def check_shard_count(count: Optional[int]):
+    """
+    Raise ShardCountMismatch if a shard recorded a different shard count.
+    Files synced before the count was recorded hold NULL and pass.
+    """
+
+    if count is not None and count != ANALYTICS_SHARDS:
+        raise ShardCountMismatch(
+            f"DuckDB was sharded {count} ways, ANALYTICS_SHARDS is "
+            f"{ANALYTICS_SHARDS}; run python -m cli.reshard"
+        )
+
+
+def get_duck_conn(read_only: bool = False, shard: int = 0):
+    """
+    Establish a connection to the DuckDB database of one shard.
+
+    This is the writer's working copy; API readers go through Snapshot.
+    """
 
+    path = shard_path(shard)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return duckdb.connect(str(path), read_only=read_only)
 
-def get_duck_conn(read_only: bool = False):
+
+def has_snapshot(shard: int = 0) -> bool:
+    return (_snapshot_dir(shard) / "CURRENT").exists()
+
+
+def snapshot_is_stale(shard: int = 0) -> bool:
+    """
+    Return True if the working DuckDB file changed after the current
+    snapshot was published, or if it exists and was never published.
+    """
+
+    try:
+        working = shard_path(shard).stat().st_mtime_ns
+    except FileNotFoundError:
+        return False
+    try:
+        published = (_snapshot_dir(shard) / "CURRENT").stat().st_mtime_ns
+    except FileNotFoundError:
+        return True
+    return working > published
+
+
+@contextmanager
+def _publish_lock(snapshot_dir: Path):
+    """
+    Serialize publishers of one shard across processes (beat and
+    cli.replay_log may publish at the same time), so one never retires
+    the snapshot another has just pointed CURRENT at.
+    """
+
+    with open(snapshot_dir / "publish.lock", "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def publish_snapshot(shard: int = 0):
     """
-    Establish a connection to the DuckDB database.
+    Publish the working DuckDB file as a new read-only snapshot.
+
+    The file is copied under a new versioned name and the CURRENT pointer is
+    swapped with an atomic rename, so readers see either the old or the new
+    snapshot and never the writer's lock. Snapshots no reader holds are
+    then retired.
+
+    A read-only connection is held on the working file while it is copied,
+    which keeps the writer out; if the writer has it open, this raises
+    duckdb.IOException (or duckdb.ConnectionException in the same process).
+    Publishers of the same shard take turns on a lock file.
     """
 
-    DUCKDB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    return duckdb.connect(str(DUCKDB_PATH), read_only=read_only)
+    snapshot_dir = _snapshot_dir(shard)
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+
+    with _publish_lock(snapshot_dir):
+        name = f"analytics-{time.time_ns()}.duckdb"
+        tmp_path = snapshot_dir / f"{name}.tmp"
+
+        conn = get_duck_conn(read_only=True, shard=shard)
+        try:
+            shutil.copyfile(shard_path(shard), tmp_path)
+        finally:
+            conn.close()
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, snapshot_dir / name)
+
+        pointer_tmp = snapshot_dir / "CURRENT.tmp"
+        pointer_tmp.write_text(name)
+        os.replace(pointer_tmp, snapshot_dir / "CURRENT")
+
+        _retire_snapshots(snapshot_dir, current=name)
 
 
-def query_analytics(sql: str, params: List[Any] = None):
+def _retire_snapshots(snapshot_dir: Path, current: str):
+    snapshots = sorted(snapshot_dir.glob("analytics-*.duckdb"))
+    old = [path for path in snapshots if path.name != current]
+    if fcntl is None:
+        old = old[:-1]
+
+    for path in old:
+        if fcntl is None:
+            path.unlink()
+            continue
+        with open(path, "rb") as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            path.unlink()
+
+
+class Snapshot:
     """
-    Execute a read-only SQL query on the DuckDB database and return results.
+    Read-only connection to the currently published snapshot.
+
+    A shared lock is held on the snapshot file until close(), which keeps
+    the writer from retiring it while queries are running.
+
+    The pointer is re-read up to SNAPSHOT_OPEN_ATTEMPTS times if the file
+    it names disappears; a pointer that stays dangling raises
+    duckdb.IOException.
     """
 
-    conn = get_duck_conn(read_only=True)
+    def __init__(self, shard: int = 0):
+        snapshot_dir = _snapshot_dir(shard)
+        pointer = snapshot_dir / "CURRENT"
+        for _ in range(SNAPSHOT_OPEN_ATTEMPTS):
+            try:
+                path = snapshot_dir / pointer.read_text().strip()
+                self._file = open(path, "rb")
+            except FileNotFoundError:
+                if not pointer.exists():
+                    if stray_snapshot_dirs():
+                        raise ShardCountMismatch(
+                            "Analytics snapshots were published for another "
+                            "ANALYTICS_SHARDS setting; run python -m cli.reshard"
+                        )
+                    raise duckdb.IOException("No analytics snapshot published yet")
+                continue
+
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_SH)
+            if os.fstat(self._file.fileno()).st_nlink:
+                break
+            # Retired between reading the pointer and taking the lock.
+            self._file.close()
+        else:
+            raise duckdb.IOException(
+                f"Analytics snapshot named by {pointer} is missing"
+            )
+
+        try:
+            self.conn = duckdb.connect(str(path), read_only=True)
+        except Exception:
+            self._file.close()
+            raise
+
+    def close(self):
+        try:
+            self.conn.close()
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def query_analytics(sql: str, params: List[Any] = None, shard: int = 0):
+    """
+    Execute a read-only SQL query on the published snapshot of one shard
+    and return results.
+
+    The query is interrupted after DUCKDB_QUERY_TIMEOUT seconds, or as soon
+    as the current QueryScope is cancelled, raising QueryCancelled.
+    When the request is being profiled, the query is recorded with its
+    timings, and with DuckDB's operator profile if an explain was asked.
+    """
+
+    profile = current_profile.get()
+    with phase("duckdb_open"):
+        snapshot = Snapshot(shard)
+    conn = snapshot.conn
+    scope = current_scope.get()
+    timer = threading.Timer(DUCKDB_QUERY_TIMEOUT, conn.interrupt)
+
+    profile_path = None
+    if profile is not None and profile.explain:
+        fd, profile_path = tempfile.mkstemp(prefix="duck-profile-", suffix=".json")
+        os.close(fd)
+        conn.execute("PRAGMA enable_profiling='json'")
+        conn.execute("SET profiling_mode='detailed'")
+        conn.execute(f"SET profiling_output='{profile_path}'")
 
     try:
+        if scope is not None:
+            scope.register(conn)
+        timer.start()
+        started = time.perf_counter()
         if params:
-            return conn.execute(sql, params).fetchall()
-        return conn.execute(sql).fetchall()
+            rows = conn.execute(sql, params).fetchall()
+        else:
+            rows = conn.execute(sql).fetchall()
+    except duckdb.InterruptException as e:
+        if scope is not None and scope.cancelled:
+            raise QueryCancelled("Request was cancelled") from e
+        raise QueryCancelled(
+            f"Analytics query exceeded {DUCKDB_QUERY_TIMEOUT:g}s time budget"
+        ) from e
     finally:
-        conn.close()
+        timer.cancel()
+        if scope is not None:
+            scope.unregister(conn)
+        snapshot.close()
+        if profile_path is not None:
+            with open(profile_path) as f:
+                duck_profile = f.read()
+            os.unlink(profile_path)
+
+    if profile is not None:
+        elapsed = time.perf_counter() - started
+        profile.add_phase("duckdb_query", elapsed)
+        entry = dict(
+            store="duckdb",
+            shard=shard,
+            sql=sql,
+            params=params,
+            ms=round(elapsed * 1000, 3),
+            rows=len(rows),
+        )
+        if profile_path is not None:
+            entry.update(render_duck_plan(json.loads(duck_profile)))
+        profile.add_query(**entry)
+
+    return rows
+
+
+def query_shards(sql: str, params: List[Any] = None) -> List[list]:
+    """
+    Run the same query on every shard in parallel and return the rows of
+    each shard. DuckDB releases the GIL while executing, so shards are
+    scanned on separate cores. Every shard holds a disjoint set of users,
+    so per-user aggregates such as distinct-user counts can be summed.
+    """
+
+    if ANALYTICS_SHARDS == 1:
+        return [query_analytics(sql, params)]
+
+    # Each task gets its own copy of the context, so the request's
+    # QueryScope can still interrupt queries running on pool threads.
+    futures = [
+        _fanout_pool.submit(copy_context().run, query_analytics, sql, params, shard)
+        for shard in range(ANALYTICS_SHARDS)
+    ]
+    return [future.result() for future in futures]
 
 
 def write_analytics(conn, sql: str, data: list = None):
@@ -42,3 +428,33 @@ def write_analytics(conn, sql: str, data: list = None):
     else:
         conn.execute(sql)
     conn.commit()
+
+
+def get_sync_watermark() -> Optional[datetime]:
+    """
+    Return the occurred_at up to which events have been synced to DuckDB,
+    or None if nothing has been synced yet. With several shards this is
+    the lowest watermark, i.e. the point every shard has reached.
+
+    Raises ShardCountMismatch if a shard was written for another
+    ANALYTICS_SHARDS setting.
+    """
+
+    # Snapshots published before the shard count was recorded have no
+    # shards column, so it is selected only if present.
+    try:
+        shards = query_shards(
+            "SELECT COLUMNS('^(watermark|shards)$') FROM sync_state "
+            "WHERE name = 'events'"
+        )
+    except duckdb.CatalogException:
+        return None
+
+    for rows in shards:
+        if rows and len(rows[0]) > 1:
+            check_shard_count(rows[0][1])
+
+    watermarks = [rows[0][0] if rows else None for rows in shards]
+    if None in watermarks:
+        return None
+    return min(watermarks)
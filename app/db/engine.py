@@ -1,14 +1,72 @@
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-DATABASE_URL = "sqlite:///./database.db"
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./database.db")
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 30000,
+    "cache_size": -64000,
+    "temp_store": "MEMORY",
+    "mmap_size": 268435456,
+}
+
+
+def _configure_sqlite(engine, immediate: bool = False):
+    """
+    Apply the tuned pragmas to every new SQLite connection.
+
+    With `immediate`, transactions start with BEGIN IMMEDIATE, so a writer
+    takes the write lock up front and waits on busy_timeout instead of
+    failing with "database is locked" when upgrading a read transaction.
+    """
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_conn, connection_record):
+        dbapi_conn.isolation_level = None
+        cursor = dbapi_conn.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
 
-connect_args = {"check_same_thread": False}
-engine = create_engine(DATABASE_URL, connect_args=connect_args)
+    @event.listens_for(engine, "begin")
+    def begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE" if immediate else "BEGIN")
+
+
+if IS_SQLITE:
+    connect_args = {"check_same_thread": False}
+    engine = create_engine(DATABASE_URL, connect_args=connect_args)
+    _configure_sqlite(engine)
+
+    # SQLite allows a single writer, so writes share one dedicated connection
+    # per process instead of contending for the lock from the read pool.
+    write_engine = create_engine(
+        DATABASE_URL, connect_args=connect_args, pool_size=1, max_overflow=0
+    )
+    _configure_sqlite(write_engine, immediate=True)
+else:
+    engine = create_engine(
+        DATABASE_URL,
+        pool_size=int(os.getenv("DB_POOL_SIZE", 10)),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 20)),
+        pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", 30)),
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        pool_pre_ping=True,
+    )
+    write_engine = engine
 
 Base = declarative_base()
 
 SessionLocal = sessionmaker(
     bind=engine, expire_on_commit=False, autocommit=False, autoflush=False
 )
+
+WriteSessionLocal = sessionmaker(
+    bind=write_engine, expire_on_commit=False, autocommit=False, autoflush=False
+)
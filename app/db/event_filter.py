@@ -0,0 +1,353 @@
+import hashlib
+import math
+import os
+import struct
+import tempfile
+import threading
+import uuid
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from sqlalchemy.orm import Session
+
+from app.db import models
+
+
+BASE_DIR = Path(__file__).resolve().parents[2]
+EVENT_FILTER_PATH = Path(os.getenv("EVENT_FILTER_PATH", BASE_DIR / "event_ids.bloom"))
+EVENT_FILTER_CAPACITY = int(os.getenv("EVENT_FILTER_CAPACITY", 1_000_000))
+EVENT_FILTER_ERROR_RATE = float(os.getenv("EVENT_FILTER_ERROR_RATE", 0.001))
+EVENT_FILTER_REDIS_URL = os.getenv("EVENT_FILTER_REDIS_URL")
+EVENT_FILTER_SAVE_EVERY = int(os.getenv("EVENT_FILTER_SAVE_EVERY", 50_000))
+EVENT_FILTER_REBUILD_LOCK_SECONDS = int(
+    os.getenv("EVENT_FILTER_REBUILD_LOCK_SECONDS", 600)
+)
+
+_FILE_MAGIC = b"EVBLOOM1"
+_HEADER = struct.Struct("<8sQdQQ")
+
+
+def _key(event_id) -> bytes:
+    if isinstance(event_id, uuid.UUID):
+        return event_id.bytes
+    return uuid.UUID(str(event_id)).bytes
+
+
+class LocalBits:
+    """
+    Bit array kept in process memory.
+    """
+
+    def __init__(self, size: int, data: Optional[bytes] = None):
+        self.size = size
+        self.data = bytearray(data) if data else bytearray((size + 7) // 8)
+
+    def get_many(self, positions: List[int]) -> List[bool]:
+        data = self.data
+        return [bool(data[p >> 3] & (1 << (p & 7))) for p in positions]
+
+    def set_many(self, positions: List[int]):
+        data = self.data
+        for p in positions:
+            data[p >> 3] |= 1 << (p & 7)
+
+
+class RedisBits:
+    """
+    Bit array stored in a Redis string, shared by every worker and API process.
+    All reads or writes for a batch are sent as a single BITFIELD command
+    of u1 fields, which address the same bits as GETBIT/SETBIT.
+    """
+
+    def __init__(self, client, key: str, size: int):
+        self.client = client
+        self.key = key
+        self.size = size
+
+    def get_many(self, positions: List[int]) -> List[bool]:
+        if not positions:
+            return []
+        op = self.client.bitfield(self.key)
+        for p in positions:
+            op.get("u1", p)
+        return [bool(bit) for bit in op.execute()]
+
+    def set_many(self, positions: List[int]):
+        if not positions:
+            return
+        op = self.client.bitfield(self.key)
+        for p in positions:
+            op.set("u1", p, 1)
+        op.execute()
+
+
+class EventIdFilter:
+    """
+    Rotating Bloom filter over recently seen event_ids.
+
+    Two generations are kept: IDs are added to the current one, lookups check
+    both. Once the current generation holds `capacity` IDs it becomes the
+    previous one and the oldest generation is dropped, so the filter always
+    covers at least the last `capacity` IDs at the configured error rate.
+
+    A negative answer means the ID was not added during the covered window.
+    A positive answer only means "probably seen" and must be verified
+    against the database.
+
+    With `rotating=False` a single generation is kept and nothing is ever
+    dropped; past `capacity` the error rate grows instead.
+    """
+
+    def __init__(
+        self,
+        capacity: int = EVENT_FILTER_CAPACITY,
+        error_rate: float = EVENT_FILTER_ERROR_RATE,
+        redis_url: Optional[str] = EVENT_FILTER_REDIS_URL,
+        path: Path = EVENT_FILTER_PATH,
+        rotating: bool = True,
+    ):
+        self.capacity = capacity
+        self.rotating = rotating
+        self.error_rate = error_rate
+        self.path = path
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.unsaved = 0
+        self._lock = threading.Lock()
+
+        if redis_url:
+            import redis
+
+            self.redis = redis.Redis.from_url(redis_url)
+            self.local = None
+        else:
+            self.redis = None
+            self.local = self._empty_generations()
+            self.count = 0
+
+    def _empty_generations(self) -> List[LocalBits]:
+        return [LocalBits(self.size) for _ in range(2 if self.rotating else 1)]
+
+    def _positions(self, event_id) -> List[int]:
+        digest = hashlib.blake2b(_key(event_id), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def _generations(self):
+        if self.redis is None:
+            return self.local
+        gen = int(self.redis.get("event_filter:gen") or 0)
+        return [
+            RedisBits(self.redis, f"event_filter:{gen}", self.size),
+            RedisBits(self.redis, f"event_filter:{gen - 1}", self.size),
+        ]
+
+    @property
+    def is_empty(self) -> bool:
+        if self.redis is None:
+            return self.count == 0 and not any(any(gen.data) for gen in self.local[1:])
+        return not self.redis.exists("event_filter:gen")
+
+    def might_contain_many(self, event_ids: List) -> List[bool]:
+        """
+        Return, for each ID, whether it was possibly seen before.
+        """
+
+        if not event_ids:
+            return []
+
+        positions = [self._positions(e) for e in event_ids]
+        flat = [p for ps in positions for p in ps]
+
+        with self._lock:
+            hits = [gen.get_many(flat) for gen in self._generations()]
+
+        result = []
+        for i in range(len(event_ids)):
+            window = slice(i * self.hashes, (i + 1) * self.hashes)
+            result.append(any(all(bits[window]) for bits in hits))
+        return result
+
+    def add_many(self, event_ids: Iterable):
+        """
+        Record IDs as seen, rotating generations when the current one is full.
+        """
+
+        event_ids = list(event_ids)
+        if not event_ids:
+            return
+
+        with self._lock:
+            for start in range(0, len(event_ids), self.capacity):
+                chunk = event_ids[start : start + self.capacity]
+                current = self._generations()[0]
+                current.set_many([p for e in chunk for p in self._positions(e)])
+                self._count_added(len(chunk))
+
+            self.unsaved += len(event_ids)
+            if self.redis is None and self.unsaved >= EVENT_FILTER_SAVE_EVERY:
+                self._save()
+
+    def _count_added(self, n: int):
+        if self.redis is None:
+            self.count += n
+            if self.rotating and self.count >= self.capacity:
+                self.local = [LocalBits(self.size), self.local[0]]
+                self.count = 0
+            return
+
+        gen = int(self.redis.get("event_filter:gen") or 0)
+        if self.redis.incrby(f"event_filter:{gen}:count", n) < self.capacity:
+            return
+
+        def rotate(pipe):
+            if int(pipe.get("event_filter:gen") or 0) != gen:
+                return
+            pipe.multi()
+            pipe.set("event_filter:gen", gen + 1)
+            pipe.delete(f"event_filter:{gen - 1}", f"event_filter:{gen - 1}:count")
+
+        self.redis.transaction(rotate, "event_filter:gen")
+
+    def save(self):
+        """
+        Persist the local filter atomically. No-op for the Redis-backed filter.
+        """
+
+        if self.redis is None:
+            with self._lock:
+                self._save()
+
+    def _save(self):
+        header = _HEADER.pack(
+            _FILE_MAGIC, self.capacity, self.error_rate, self.size, self.count
+        )
+        # Every process saves to its own temporary file; os.replace makes
+        # the last complete write win.
+        with tempfile.NamedTemporaryFile(
+            dir=self.path.parent,
+            prefix=f"{self.path.name}.",
+            suffix=".tmp",
+            delete=False,
+        ) as f:
+            try:
+                f.write(header)
+                for gen in self.local:
+                    f.write(gen.data)
+                f.flush()
+                os.fsync(f.fileno())
+            except BaseException:
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, self.path)
+        self.unsaved = 0
+
+    def load(self) -> bool:
+        """
+        Load the local filter from disk.
+        Returns False if there is no file or it was built with other settings.
+        """
+
+        if self.redis is not None or not self.path.exists():
+            return False
+
+        with open(self.path, "rb") as f:
+            raw = f.read()
+
+        magic, capacity, error_rate, size, count = _HEADER.unpack_from(raw)
+        if (magic, capacity, error_rate, size) != (
+            _FILE_MAGIC,
+            self.capacity,
+            self.error_rate,
+            self.size,
+        ):
+            return False
+
+        nbytes = (size + 7) // 8
+        body = raw[_HEADER.size :]
+        generations = len(self.local)
+        if len(body) != generations * nbytes:
+            return False
+
+        self.local = [
+            LocalBits(size, body[i * nbytes : (i + 1) * nbytes])
+            for i in range(generations)
+        ]
+        self.count = count
+        return True
+
+    def rebuild(self, db: Session, batch_size: int = 10_000):
+        """
+        Refill the filter from the most recent event_ids in the database.
+
+        The shared Redis filter is only filled while it is missing, by one
+        process at a time holding a lock; its keys are never deleted, since
+        other processes keep reading and adding to them meanwhile. Returns
+        False if the filter was left to another process.
+        """
+
+        if self.redis is None:
+            self.local = self._empty_generations()
+            self.count = 0
+            self._fill(db, batch_size)
+            self.save()
+            return True
+
+        if not self.redis.set(
+            "event_filter:rebuild",
+            os.getpid(),
+            nx=True,
+            ex=EVENT_FILTER_REBUILD_LOCK_SECONDS,
+        ):
+            return False
+        try:
+            if not self.is_empty:
+                return False
+            self._fill(db, batch_size)
+            self.redis.setnx("event_filter:gen", 0)
+        finally:
+            self.redis.delete("event_filter:rebuild")
+        return True
+
+    def _fill(self, db: Session, batch_size: int):
+        query = (
+            db.query(models.Event.event_id)
+            .order_by(models.Event.occurred_at.desc())
+            .limit(self.capacity)
+            .yield_per(batch_size)
+        )
+        batch = []
+        for (event_id,) in query:
+            batch.append(event_id)
+            if len(batch) >= batch_size:
+                self.add_many(batch)
+                batch = []
+        self.add_many(batch)
+
+
+_event_filter: Optional[EventIdFilter] = None
+
+
+def get_event_id_filter() -> EventIdFilter:
+    """
+    Return the process-wide filter, loading the persisted copy on first use.
+    """
+
+    global _event_filter
+    if _event_filter is None:
+        _event_filter = EventIdFilter()
+        _event_filter.load()
+    return _event_filter
+
+
+def warm_event_id_filter(db: Session) -> EventIdFilter:
+    """
+    Make the filter ready at startup: use the persisted copy if it exists,
+    otherwise rebuild it from the store.
+    """
+
+    event_filter = get_event_id_filter()
+    if event_filter.is_empty:
+        event_filter.rebuild(db)
+    return event_filter
@@ -0,0 +1,162 @@
+import io
+import os
+import zlib
+from datetime import date
+from typing import Dict, Iterator, List, Optional
+
+import duckdb
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+import app.crud as crud
+from app.db.duck import (
+    ANALYTICS_SHARDS,
+    QueryCancelled,
+    QueryScope,
+    Snapshot,
+    current_scope,
+)
+
+
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", 65536))
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+
+
+class _ChunkSink(io.RawIOBase):
+    """
+    Write-only file object that hands written bytes back in chunks.
+    It keeps counting the position across drains, as Parquet needs
+    correct offsets for its footer.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _open_writer(fmt: str, sink: _ChunkSink, schema: pa.Schema):
+    if fmt == "csv":
+        return pa_csv.CSVWriter(sink, schema)
+    if fmt == "parquet":
+        return pq.ParquetWriter(sink, schema, compression="zstd")
+    return pa.ipc.new_stream(
+        sink, schema, options=pa.ipc.IpcWriteOptions(compression="zstd")
+    )
+
+
+def _close_snapshots(snapshots: List[Snapshot], scope: Optional[QueryScope]):
+    for snapshot in snapshots:
+        if scope is not None:
+            scope.unregister(snapshot.conn)
+        snapshot.close()
+
+
+def _stream_batches(
+    snapshots: List[Snapshot], readers, fmt: str, scope: Optional[QueryScope]
+) -> Iterator[bytes]:
+    """
+    Encode the batches of every shard's reader, one shard after another,
+    into a single output stream.
+    """
+
+    try:
+        if fmt == "ndjson":
+            for reader in readers:
+                for batch in reader:
+                    if batch.num_rows:
+                        lines = batch.column(0).to_pylist()
+                        yield ("\n".join(lines) + "\n").encode()
+            return
+
+        sink = _ChunkSink()
+        writer = _open_writer(fmt, sink, readers[0].schema)
+        for reader in readers:
+            for batch in reader:
+                writer.write_batch(batch)
+                yield sink.drain()
+        writer.close()
+        yield sink.drain()
+    except duckdb.InterruptException as e:
+        raise QueryCancelled("Export was cancelled or ran out of time") from e
+    finally:
+        _close_snapshots(snapshots, scope)
+
+
+def _gzip(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        chunks.close()
+
+
+def stream_events(
+    fmt: str,
+    from_: date,
+    to: date,
+    filter_params: Optional[Dict] = None,
+    gzip: bool = False,
+) -> Iterator[bytes]:
+    """
+    Stream raw events for a date range from DuckDB in the requested format.
+
+    Rows are pulled as Arrow record batches of EXPORT_BATCH_ROWS and each
+    batch is encoded and yielded before the next one is fetched, so memory
+    stays flat regardless of the export size. The query runs before this
+    function returns, so errors surface before the response starts.
+    With a sharded store the shards are exported one after another.
+
+    The readers are registered with the current QueryScope, so cancelling
+    it interrupts the export (see guards.run_export).
+    """
+
+    sql, params = crud.get_export_sql(from_, to, filter_params, as_json=fmt == "ndjson")
+    scope = current_scope.get()
+
+    snapshots, readers = [], []
+    try:
+        for shard in range(ANALYTICS_SHARDS):
+            snapshots.append(Snapshot(shard))
+            if scope is not None:
+                scope.register(snapshots[-1].conn)
+            readers.append(
+                snapshots[-1]
+                .conn.execute(sql, params)
+                .fetch_record_batch(EXPORT_BATCH_ROWS)
+            )
+    except duckdb.InterruptException as e:
+        _close_snapshots(snapshots, scope)
+        raise QueryCancelled("Export was cancelled or ran out of time") from e
+    except BaseException:
+        _close_snapshots(snapshots, scope)
+        raise
+
+    chunks = _stream_batches(snapshots, readers, fmt, scope)
+    return _gzip(chunks) if gzip else chunks
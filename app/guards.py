@@ -0,0 +1,296 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from fastapi import HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.db.duck import QueryCancelled, QueryScope, current_scope
+from app.logger import logger
+from app.profiling import current_profile
+from app.timezones import local_day_bounds
+
+
+MAX_RANGE_DAYS = int(os.getenv("STATS_MAX_RANGE_DAYS", 366))
+MAX_RETENTION_WINDOWS = int(os.getenv("STATS_MAX_RETENTION_WINDOWS", 90))
+MAX_TOP_EVENTS_LIMIT = int(os.getenv("STATS_MAX_TOP_EVENTS_LIMIT", 100))
+
+ANALYTICS_MAX_CONCURRENCY = int(os.getenv("ANALYTICS_MAX_CONCURRENCY", 4))
+ANALYTICS_OLTP_TIMEOUT = float(os.getenv("ANALYTICS_OLTP_TIMEOUT", 10))
+EXPORT_MAX_CONCURRENCY = int(os.getenv("EXPORT_MAX_CONCURRENCY", 2))
+EXPORT_TIMEOUT = float(os.getenv("EXPORT_TIMEOUT", 600))
+DISCONNECT_POLL_INTERVAL = 0.1
+CANCEL_WAIT_SECONDS = float(os.getenv("ANALYTICS_CANCEL_WAIT_SECONDS", 5))
+
+_executor = ThreadPoolExecutor(
+    max_workers=ANALYTICS_MAX_CONCURRENCY, thread_name_prefix="analytics"
+)
+_slots = threading.BoundedSemaphore(ANALYTICS_MAX_CONCURRENCY)
+_export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENCY)
+
+
+def check_date_range(from_: date, to: date):
+    """
+    Reject date ranges that are inverted or longer than MAX_RANGE_DAYS.
+    """
+
+    if to < from_:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_CONTENT,
+            detail="'to' must not be earlier than 'from'",
+        )
+    if (to - from_).days + 1 > MAX_RANGE_DAYS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_CONTENT,
+            detail=f"Date range must not exceed {MAX_RANGE_DAYS} days",
+        )
+
+
+def check_timezone(name: Optional[str], from_: date, to: date) -> Optional[ZoneInfo]:
+    """
+    Resolve the `tz` parameter. Returns None for UTC, which keeps the
+    plain UTC path. Rejects unknown zones and zones whose day boundaries
+    in the range are not whole UTC hours.
+    """
+
+    if name is None or name.upper() in ("UTC", "ETC/UTC"):
+        return None
+
+    # Directory names such as "Europe" raise IsADirectoryError and very
+    # long names other OSErrors, rather than ZoneInfoNotFoundError.
+    try:
+        tz = ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError, OSError):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_CONTENT,
+            detail=f"Unknown timezone '{name}'",
+        )
+
+    try:
+        local_day_bounds(from_, to, tz)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_CONTENT,
+            detail=f"Unsupported timezone: {e}",
+        )
+    return tz
+
+
+class _OltpStatement:
+    """
+    A statement running on an OLTP connection while serving an analytics
+    request. It is interrupted after ANALYTICS_OLTP_TIMEOUT seconds, or when
+    the request's QueryScope is cancelled, like the DuckDB queries.
+    """
+
+    def __init__(self, dbapi_conn):
+        # sqlite3 connections have interrupt(), psycopg ones cancel().
+        self._interrupt = getattr(dbapi_conn, "interrupt", None) or dbapi_conn.cancel
+        self.timed_out = False
+        self.timer = threading.Timer(ANALYTICS_OLTP_TIMEOUT, self._expire)
+
+    def _expire(self):
+        self.timed_out = True
+        self._interrupt()
+
+    def interrupt(self):
+        self._interrupt()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_oltp_statement(conn, cursor, statement, parameters, context, executemany):
+    scope = current_scope.get()
+    if scope is None:
+        return
+
+    running = _OltpStatement(conn.connection.dbapi_connection)
+    scope.register(running)
+    conn.info.setdefault("analytics_statements", []).append((scope, running))
+    running.timer.start()
+
+
+def _finish_oltp_statement(conn):
+    statements = conn.info.get("analytics_statements")
+    if not statements:
+        return None
+
+    scope, running = statements.pop()
+    running.timer.cancel()
+    scope.unregister(running)
+    return scope, running
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_oltp_statement(conn, cursor, statement, parameters, context, executemany):
+    _finish_oltp_statement(conn)
+
+
+@event.listens_for(Engine, "handle_error")
+def _interrupted_oltp_statement(context):
+    if context.connection is None:
+        return
+    finished = _finish_oltp_statement(context.connection)
+    if finished is None:
+        return
+
+    scope, running = finished
+    if scope.cancelled:
+        raise QueryCancelled("Request was cancelled") from context.original_exception
+    if running.timed_out:
+        raise QueryCancelled(
+            f"Analytics query exceeded {ANALYTICS_OLTP_TIMEOUT:g}s time budget"
+        ) from context.original_exception
+
+
+def _run_in_scope(scope: QueryScope, fn, args, submitted: float):
+    current_scope.set(scope)
+    profile = current_profile.get()
+    if profile is not None:
+        profile.add_phase("queue_wait", time.perf_counter() - submitted)
+    try:
+        return fn(*args)
+    finally:
+        _slots.release()
+
+
+async def run_analytics(request: Request, fn, *args):
+    """
+    Run a blocking analytics call on the bounded analytics executor.
+
+    Responds with 503 straight away when every slot is busy instead of
+    queueing, and interrupts the running DuckDB and OLTP queries if the
+    client disconnects before the result is ready. OLTP statements run
+    under ANALYTICS_OLTP_TIMEOUT as DuckDB queries do under theirs.
+
+    After a disconnect the interrupted call is awaited, for at most
+    CANCEL_WAIT_SECONDS, before responding: the request's DB session is
+    closed right after, and must not be closed under a running query.
+    """
+
+    if not _slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Analytics is at capacity, please retry shortly",
+            headers={"Retry-After": "1"},
+        )
+
+    scope = QueryScope()
+    ctx = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    try:
+        future = loop.run_in_executor(
+            _executor, ctx.run, _run_in_scope, scope, fn, args, time.perf_counter()
+        )
+    except BaseException:
+        _slots.release()
+        raise
+
+    while True:
+        done, _ = await asyncio.wait({future}, timeout=DISCONNECT_POLL_INTERVAL)
+        if done:
+            return future.result()
+        if await request.is_disconnected():
+            scope.cancel()
+            future.add_done_callback(lambda f: f.exception())
+            done, _ = await asyncio.wait({future}, timeout=CANCEL_WAIT_SECONDS)
+            if not done:
+                logger.warning(
+                    f"Cancelled analytics call still running after "
+                    f"{CANCEL_WAIT_SECONDS:g}s"
+                )
+            raise HTTPException(status_code=499, detail="Client closed request")
+
+
+class ExportStream:
+    """
+    Async iterator over the chunks of one export, for StreamingResponse.
+
+    It holds an export slot and a QueryScope for the whole stream. The
+    scope is cancelled after EXPORT_TIMEOUT seconds, which interrupts the
+    DuckDB readers, and the stream stops as soon as the client disconnects.
+    The slot is given back when the stream ends, fails or is dropped.
+    """
+
+    def __init__(self, request: Request):
+        self.request = request
+        self.scope = QueryScope()
+        self.chunks = None
+        self.closed = False
+        self.timer = threading.Timer(EXPORT_TIMEOUT, self.scope.cancel)
+
+    async def open(self, fn, *args):
+        ctx = contextvars.copy_context()
+        ctx.run(current_scope.set, self.scope)
+        self.timer.start()
+        try:
+            self.chunks = await run_in_threadpool(ctx.run, fn, *args)
+        except BaseException:
+            self.close()
+            raise
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self.closed:
+            raise StopAsyncIteration
+        try:
+            if await self.request.is_disconnected():
+                chunk = None
+            elif self.scope.cancelled:
+                raise QueryCancelled(f"Export exceeded {EXPORT_TIMEOUT:g}s time budget")
+            else:
+                chunk = await run_in_threadpool(next, self.chunks, None)
+        except BaseException:
+            self.close()
+            raise
+
+        if chunk is None:
+            self.close()
+            raise StopAsyncIteration
+        return chunk
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.timer.cancel()
+        try:
+            if self.chunks is not None:
+                self.chunks.close()
+        finally:
+            _export_slots.release()
+
+    def __del__(self):
+        self.close()
+
+
+async def run_export(request: Request, fn, *args) -> ExportStream:
+    """
+    Start an export on its own bounded set of slots, separate from the
+    stats executor, so long exports cannot starve stats queries.
+
+    `fn` runs the export query and returns an iterator of chunks; it is
+    called in a thread with the export's QueryScope as the current scope.
+    Responds with 503 straight away when EXPORT_MAX_CONCURRENCY exports
+    are already running.
+    """
+
+    if not _export_slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many exports are running, please retry shortly",
+            headers={"Retry-After": "5"},
+        )
+
+    stream = ExportStream(request)
+    await stream.open(fn, *args)
+    return stream
@@ -0,0 +1,390 @@
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional
+
+import orjson
+
+from app.logger import logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: only appenders within one process are serialized
+    fcntl = None
+
+
+BASE_DIR = Path(__file__).resolve().parents[1]
+INGEST_LOG_DIR = Path(os.getenv("INGEST_LOG_DIR", BASE_DIR / "ingest_log"))
+INGEST_LOG_SEGMENT_BYTES = int(os.getenv("INGEST_LOG_SEGMENT_BYTES", 64 * 1024**2))
+INGEST_LOG_MAX_LAG_BYTES = int(os.getenv("INGEST_LOG_MAX_LAG_BYTES", 256 * 1024**2))
+INGEST_LOG_REDELIVER_AFTER = int(os.getenv("INGEST_LOG_REDELIVER_AFTER", 120))
+INGEST_LOG_RETENTION_DAYS = int(os.getenv("INGEST_LOG_RETENTION_DAYS", 7))
+INGEST_LOG_MAX_REDELIVERIES = int(os.getenv("INGEST_LOG_MAX_REDELIVERIES", 3))
+INGEST_LOG_READ_BYTES = 16 * 1024**2
+
+CONSUMERS = ("oltp", "analytics")
+
+
+class LogRecord(NamedTuple):
+    offset: int
+    next_offset: int
+    logged_at: float
+    events: List[dict]
+
+
+class _FileLock:
+    """
+    Exclusive flock on a lock file, shared by every process using the log.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def __enter__(self):
+        self._file = open(self.path, "a+b")
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        self._file.close()
+
+
+class IngestLog:
+    """
+    Durable, segmented append-only log of accepted event batches.
+
+    Each append is one NDJSON line holding a whole batch, addressed by its
+    byte offset across all segments. Segments are named after the offset
+    of their first line and rolled once they exceed INGEST_LOG_SEGMENT_BYTES.
+
+    Appends are fsynced before they return. Concurrent appenders share one
+    fsync: whoever syncs first covers every line written before it.
+
+    Every consumer keeps its own committed offset: everything before it has
+    been applied to that consumer's store, so either store can be rebuilt
+    by replaying the log from an earlier offset.
+    """
+
+    def __init__(self, path: Path = INGEST_LOG_DIR):
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        (self.path / "offsets").mkdir(exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._file = None
+        self._base = 0
+        self._written = 0
+        self._synced = 0
+
+    # Appending
+
+    def _segments(self) -> List[Path]:
+        return sorted(self.path.glob("*.log"))
+
+    def _open_segment(self, base: int):
+        # Called with self._lock held. Taking the sync lock keeps a
+        # concurrent fsync from seeing the old file closed under it.
+        with self._sync_lock:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+                self._file.close()
+            self._file = open(self.path / f"{base:020d}.log", "a+b")
+            self._base = base
+
+    def append(self, events: List[dict]) -> LogRecord:
+        """
+        Append a batch of events and return its record once it is durable.
+        """
+
+        logged_at = time.time()
+        line = orjson.dumps({"logged_at": logged_at, "events": events}) + b"\n"
+
+        with self._lock:
+            if self._file is None:
+                segments = self._segments()
+                self._open_segment(int(segments[-1].stem) if segments else 0)
+
+            while True:
+                fd = self._file.fileno()
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                size = os.fstat(fd).st_size
+                if size < INGEST_LOG_SEGMENT_BYTES:
+                    break
+                # Full: this segment is never written again, so the next one
+                # starts exactly where it ends. Another process may have
+                # created it already.
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                self._open_segment(self._base + size)
+
+            try:
+                if size and os.pread(fd, 1, size - 1) != b"\n":
+                    # Torn write from a crashed appender: terminate it so it
+                    # cannot swallow this line.
+                    self._file.write(b"\n")
+                    size += 1
+                self._file.write(line)
+                self._file.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+
+            offset = self._base + size
+            self._written = offset + len(line)
+
+        self._sync(offset + len(line))
+        return LogRecord(offset, offset + len(line), logged_at, events)
+
+    def _sync(self, end: int):
+        with self._sync_lock:
+            if self._synced >= end:
+                return
+            # Everything written so far is in the current file (a roll
+            # fsyncs the previous one), so one fsync covers every waiter.
+            target = self._written
+            os.fsync(self._file.fileno())
+            self._synced = target
+
+    def start_offset(self) -> int:
+        """
+        Return the oldest offset still on disk; everything before it was
+        pruned.
+        """
+
+        segments = self._segments()
+        if not segments:
+            return 0
+        return int(segments[0].stem)
+
+    def end_offset(self) -> int:
+        segments = self._segments()
+        if not segments:
+            return 0
+        return int(segments[-1].stem) + segments[-1].stat().st_size
+
+    # Reading
+
+    def read(
+        self, offset: int, max_bytes: int = INGEST_LOG_READ_BYTES
+    ) -> List[LogRecord]:
+        """
+        Return complete records starting at `offset`, stopping once about
+        `max_bytes` have been read.
+        """
+
+        segments = self._segments()
+        records: List[LogRecord] = []
+        read = 0
+
+        for i, segment in enumerate(segments):
+            base = int(segment.stem)
+            next_base = int(segments[i + 1].stem) if i + 1 < len(segments) else None
+            if next_base is not None and offset >= next_base:
+                continue
+            if offset < base:
+                logger.warning(
+                    f"Ingest log offset {offset} was pruned, resuming at {base}"
+                )
+                records.append(LogRecord(offset, base, 0.0, []))
+                offset = base
+
+            with open(segment, "rb") as f:
+                f.seek(offset - base)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        if next_base is None:
+                            return records  # still being written
+                        logger.warning(f"Skipping torn ingest log line at {offset}")
+                        records.append(LogRecord(offset, next_base, 0.0, []))
+                        break
+
+                    records.append(self._parse(offset, line))
+                    offset += len(line)
+                    read += len(line)
+                    if read >= max_bytes:
+                        return records
+
+            if next_base is not None:
+                offset = next_base
+
+        return records
+
+    @staticmethod
+    def _parse(offset: int, line: bytes) -> LogRecord:
+        try:
+            body = orjson.loads(line)
+            return LogRecord(
+                offset, offset + len(line), body["logged_at"], body["events"]
+            )
+        except (orjson.JSONDecodeError, KeyError, TypeError):
+            # Kept as an empty record so consumers still move past it.
+            logger.warning(f"Skipping corrupt ingest log line at {offset}")
+            return LogRecord(offset, offset + len(line), 0.0, [])
+
+    def read_at(self, offset: int) -> LogRecord:
+        records = self.read(offset, max_bytes=1)
+        if not records or records[0].offset != offset:
+            raise LookupError(f"No ingest log record at offset {offset}")
+        return records[0]
+
+    def scan(self, offset: int) -> Iterator[List[LogRecord]]:
+        """
+        Yield chunks of records from `offset` up to the current end.
+        """
+
+        while True:
+            records = self.read(offset)
+            if not records:
+                return
+            yield records
+            offset = records[-1].next_offset
+
+    # Consumer offsets
+
+    def _offset_path(self, consumer: str) -> Path:
+        return self.path / "offsets" / f"{consumer}.json"
+
+    def _load_offsets(self, consumer: str) -> dict:
+        try:
+            return orjson.loads(self._offset_path(consumer).read_bytes())
+        except FileNotFoundError:
+            return {"offset": 0, "acked": []}
+
+    def _store_offsets(self, consumer: str, state: dict):
+        path = self._offset_path(consumer)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(orjson.dumps(state))
+        os.replace(tmp_path, path)
+
+    def committed(self, consumer: str) -> int:
+        return self._load_offsets(consumer)["offset"]
+
+    def commit(self, consumer: str, offset: int):
+        """
+        Record that `consumer` has applied everything before `offset`.
+        """
+
+        with _FileLock(self._offset_path(consumer).with_suffix(".lock")):
+            state = self._load_offsets(consumer)
+            state["offset"] = offset
+            state["acked"] = [r for r in state["acked"] if r[1] > offset]
+            self._store_offsets(consumer, state)
+
+    def ack(self, consumer: str, offset: int, next_offset: int):
+        """
+        Record that one record was applied. Records may be acked out of
+        order; the committed offset only moves over a contiguous prefix.
+        """
+
+        with _FileLock(self._offset_path(consumer).with_suffix(".lock")):
+            state = self._load_offsets(consumer)
+            acked = dict(state["acked"])
+            acked[offset] = next_offset
+
+            committed = state["offset"]
+            while committed in acked:
+                committed = acked.pop(committed)
+            state["offset"] = committed
+            state["acked"] = sorted(
+                [start, end] for start, end in acked.items() if end > committed
+            )
+            state["failures"] = {
+                start: count
+                for start, count in state.get("failures", {}).items()
+                if int(start) >= committed and int(start) != offset
+            }
+            self._store_offsets(consumer, state)
+
+    def fail(self, consumer: str, record: LogRecord, error: str) -> bool:
+        """
+        Count a failed attempt to apply a record. After
+        INGEST_LOG_MAX_REDELIVERIES failures the record is written to the
+        consumer's dead-letter file and acked, so it no longer holds back
+        the committed offset. Returns True if it was dead-lettered.
+        """
+
+        key = str(record.offset)
+        with _FileLock(self._offset_path(consumer).with_suffix(".lock")):
+            state = self._load_offsets(consumer)
+            failures = dict(state.get("failures", {}))
+            failures[key] = failures.get(key, 0) + 1
+            dead = failures[key] >= INGEST_LOG_MAX_REDELIVERIES
+            if dead:
+                del failures[key]
+            state["failures"] = failures
+            self._store_offsets(consumer, state)
+
+        if dead:
+            self._dead_letter(consumer, record, error)
+            self.ack(consumer, record.offset, record.next_offset)
+        return dead
+
+    def dead_letter_path(self, consumer: str) -> Path:
+        return self.path / "dead_letter" / f"{consumer}.ndjson"
+
+    def _dead_letter(self, consumer: str, record: LogRecord, error: str):
+        path = self.dead_letter_path(consumer)
+        path.parent.mkdir(exist_ok=True)
+        line = orjson.dumps({**record._asdict(), "error": error}) + b"\n"
+        with _FileLock(path.with_suffix(".lock")):
+            with open(path, "ab") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def unacked(self, consumer: str, before: float) -> Iterator[LogRecord]:
+        """
+        Yield records past the committed offset that were never acked and
+        were logged before the `before` timestamp.
+        """
+
+        state = self._load_offsets(consumer)
+        acked = {start for start, _ in state["acked"]}
+        for records in self.scan(state["offset"]):
+            for record in records:
+                if record.logged_at >= before:
+                    return
+                if record.offset not in acked:
+                    yield record
+
+    def lag(self) -> int:
+        """
+        Bytes appended but not yet applied by the slowest consumer.
+        """
+
+        end = self.end_offset()
+        return max(end - self.committed(c) for c in CONSUMERS)
+
+    def prune(self) -> int:
+        """
+        Delete segments every consumer is past and that are older than
+        INGEST_LOG_RETENTION_DAYS. The active segment is always kept.
+        """
+
+        low = min(self.committed(c) for c in CONSUMERS)
+        cutoff = time.time() - INGEST_LOG_RETENTION_DAYS * 86400
+        segments = self._segments()
+        removed = 0
+        for segment, following in zip(segments, segments[1:]):
+            if int(following.stem) <= low and segment.stat().st_mtime < cutoff:
+                segment.unlink()
+                removed += 1
+        return removed
+
+
+_ingest_log: Optional[IngestLog] = None
+
+
+def get_ingest_log() -> IngestLog:
+    """
+    Return the process-wide ingest log.
+    """
+
+    global _ingest_log
+    if _ingest_log is None:
+        _ingest_log = IngestLog()
+    return _ingest_log
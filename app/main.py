@@ -1,4 +1,4 @@
-from datetime import date
+from datetime import date, timedelta
 import json
 import time
 from typing import List, Optional
@@ -6,18 +6,33 @@ import traceback
 
 import duckdb
 from fastapi import FastAPI, Depends, HTTPException, Query, status, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.orm import Session
-from celery.result import AsyncResult
 from slowapi.errors import RateLimitExceeded
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 
-import app.crud as crud
+import app.query_router as query_router
 import app.schemas as schemas
 from app.celery_ import celery_app
 from app.db.db_depends import get_db
+from app.db.duck import QueryCancelled, ShardCountMismatch
+from app.export import EXPORT_FORMATS, stream_events
+from app.guards import (
+    MAX_RETENTION_WINDOWS,
+    MAX_TOP_EVENTS_LIMIT,
+    check_date_range,
+    check_timezone,
+    run_analytics,
+    run_export,
+)
+from app.ingest_log import INGEST_LOG_MAX_LAG_BYTES, get_ingest_log
 from app.tasks import create_events_task
 from app.logger import logger
+from app.profiling import profile_request
+from app.responses import render_stats
+from app.task_status import get_task_statuses
 
 
 app = FastAPI()
@@ -28,6 +43,24 @@ app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 
+@app.exception_handler(QueryCancelled)
+async def query_cancelled_handler(request: Request, exc: QueryCancelled):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": str(exc)},
+        headers={"Retry-After": "5"},
+    )
+
+
+@app.exception_handler(ShardCountMismatch)
+async def shard_count_mismatch_handler(request: Request, exc: ShardCountMismatch):
+    logger.error(str(exc))
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Analytics store is being resharded"},
+    )
+
+
 @app.middleware("http")
 async def log_exceptions_middleware(request: Request, call_next):
     """
@@ -76,6 +109,26 @@ async def log_exceptions_middleware(request: Request, call_next):
     return response
 
 
+def parse_segment(segment: Optional[str]) -> Optional[dict]:
+    """
+    Parse a segment filter in the 'event_type:value' or
+    'properties.field=value' format into filter params.
+    """
+
+    if segment:
+        if ":" in segment:
+            key, value = segment.split(":", 1)
+            if key == "event_type":
+                return {"event_type": value}
+        elif "=" in segment:
+            key, value = segment.split("=", 1)
+            if key.startswith("properties."):
+                property_name = key.split(".", 1)[1]
+                return {"properties": {property_name: value}}
+
+    return None
+
+
 @app.post(
     "/events/",
     response_model=schemas.TaskResponse,
@@ -94,9 +147,24 @@ async def add_events(request: Request, events_data: List[schemas.EventCreate]):
       - properties (JSON object, optional)
 
     Ensures idempotency — duplicate event_ids will be ignored.
+
+    The batch is durably appended to the ingest log before it is accepted;
+    the task only carries its log offset. Returns 503 while consumers lag
+    more than INGEST_LOG_MAX_LAG_BYTES behind the log.
     """
 
-    task = create_events_task.delay([e.model_dump() for e in events_data])
+    ingest_log = get_ingest_log()
+    if await run_in_threadpool(ingest_log.lag) > INGEST_LOG_MAX_LAG_BYTES:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Event processing is falling behind, please retry later",
+            headers={"Retry-After": "30"},
+        )
+
+    record = await run_in_threadpool(
+        ingest_log.append, [e.model_dump() for e in events_data]
+    )
+    task = create_events_task.delay(record.offset)
 
     return schemas.TaskResponse(
         message="Events accepted for processing",
@@ -105,36 +173,104 @@ async def add_events(request: Request, events_data: List[schemas.EventCreate]):
     )
 
 
-@app.get("/tasks/{task_id}")
-def get_task(request: Request, task_id: str):
-    """
-    Function that allows to get tasks id, status, path to result.
+@app.get("/events/export")
+@limiter.limit("5/minute")
+async def export_events(
+    request: Request,
+    from_: date = Query(..., alias="from"),
+    to: date = Query(...),
+    fmt: str = Query("csv", alias="format", pattern="^(csv|ndjson|parquet|arrow)$"),
+    segment: Optional[str] = Query(
+        None, description="Format: 'event_type:value' or 'properties.field=value'"
+    ),
+):
     """
+    Stream raw events for a date range from the analytics store.
+    Each row has event_id, user_id, occurred_at, event_type and properties.
 
-    task_res = AsyncResult(task_id, app=celery_app)
+    Query Parameters:
+      - from: start date (inclusive)
+      - to: end date (inclusive), at most 366 days after 'from'
+      - format: csv (default), ndjson, parquet or arrow (Arrow IPC stream)
+      - segment: filter events by segment (e.g., 'event_type:purchase' or 'properties.country=UA')
 
-    if task_res.state == "SUCCESS":
-        return schemas.TaskStatus(task_id=task_id, status=task_res.state)
+    The response is sent chunked while rows are read, so exports of any size
+    use constant server memory. CSV and NDJSON are gzip-compressed when the
+    client accepts it; Parquet and Arrow are zstd-compressed internally.
 
-    elif task_res.state == "FAILURE":
-        return schemas.TaskStatus(task_id=task_id, status=task_res.state)
+    At most EXPORT_MAX_CONCURRENCY exports run at once (503 beyond that);
+    each is stopped after EXPORT_TIMEOUT seconds or when the client
+    disconnects.
+    """
+
+    check_date_range(from_, to)
+    media_type, extension = EXPORT_FORMATS[fmt]
+    gzip = fmt in ("csv", "ndjson") and "gzip" in request.headers.get(
+        "accept-encoding", ""
+    )
 
-    else:
+    try:
+        chunks = await run_export(
+            request, stream_events, fmt, from_, to, parse_segment(segment), gzip
+        )
+    except duckdb.Error as e:
+        logger.warning(f"Export from DuckDB failed: {e}")
         raise HTTPException(
-            status_code=404,
-            detail=f"Task with id: {task_id} was not found or in progress",
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Analytics store is not available, please retry later",
         )
 
+    headers = {
+        "Content-Disposition": f'attachment; filename="events_{from_}_{to}.{extension}"'
+    }
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
+
+
+@app.post("/tasks/status", response_model=schemas.TaskStatusBatch)
+@limiter.limit("60/minute")
+def get_tasks_status(request: Request, body: schemas.TaskStatusRequest):
+    """
+    Get the status of many tasks in a single call.
+
+    Accepts up to 1000 task IDs. Results are read from Redis in pipelined
+    batches and returned in the same order as the requested IDs.
+    Successful tasks include their ingestion receipt.
+    """
+
+    return schemas.TaskStatusBatch(results=get_task_statuses(celery_app, body.task_ids))
+
+
+@app.get("/tasks/{task_id}", response_model=schemas.TaskStatus)
+def get_task(request: Request, task_id: str):
+    """
+    Function that allows to get tasks id, status and ingestion receipt.
+
+    Status is one of PENDING, STARTED, RETRY, SUCCESS or FAILURE.
+    Unknown task IDs are reported as PENDING, as Celery cannot tell
+    them apart from tasks still waiting in the queue.
+    """
+
+    return get_task_statuses(celery_app, [task_id])[0]
+
 
 @app.get("/stats/dau")
 @limiter.limit("60/minute")
-def get_dau(
+async def get_dau(
     request: Request,
     from_: date = Query(..., alias="from"),
     to: date = Query(...),
     segment: Optional[str] = Query(
         None, description="Format: 'event_type:value' or 'properties.field=value'"
     ),
+    tz: Optional[str] = Query(
+        None, description="IANA timezone for day boundaries, e.g. 'Europe/Kyiv'"
+    ),
+    profile: bool = Query(
+        False, description="Return per-phase timings, SQL and DuckDB query plans"
+    ),
     db: Session = Depends(get_db),
 ):
     """
@@ -142,43 +278,51 @@ def get_dau(
 
     Query Parameters:
       - from: start date (inclusive)
-      - to: end date (inclusive)
+      - to: end date (inclusive), at most 366 days after 'from'
       - segment: filter events by segment (e.g., 'event_type:purchase' or 'properties.country=UA')
+      - tz: IANA timezone whose local days are counted (default UTC); it
+        must be a whole number of hours from UTC and cannot be combined
+        with a segment
+      - profile: if true, wrap the result as {"data": ..., "profile": ...}
+        with per-phase timings, executed SQL and DuckDB query plans
 
     Returns the count of unique user_id values per day.
-    """
-    filter_params = None
-
-    if segment:
-        if ":" in segment:
-            key, value = segment.split(":", 1)
-            if key == "event_type":
-                filter_params = {"event_type": value}
-        elif "=" in segment:
-            key, value = segment.split("=", 1)
-            if key.startswith("properties."):
-                property_name = key.split(".", 1)[1]
-                filter_params = {"properties": {property_name: value}}
 
-    try:
-        duck_res = crud.get_dau_duck(from_, to, filter_params)
-        if duck_res:
-            return duck_res
-    except duckdb.CatalogException as e:
-        logger.info(f"DuckDB table not found, falling back to SQL: {e}")
-    except Exception as e:
-        logger.warning(f"DuckDB DAU failed, fallback to SQL: {e}")
+    Responds with a JSON array of records by default. Clients can ask for
+    'application/vnd.events.columnar+json' (one array per column),
+    'application/vnd.events.rows+json' ({"columns": [...], "rows": [...]})
+    or 'application/vnd.apache.arrow.stream' (Arrow IPC) via the Accept
+    header.
+    """
+    check_date_range(from_, to)
+    filter_params = parse_segment(segment)
+    zone = check_timezone(tz, from_, to)
+    if zone is not None and filter_params is not None:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_CONTENT,
+            detail="Segments are only supported for UTC days",
+        )
 
-    return crud.get_dau(db, from_, to, filter_params)
+    with profile_request("/stats/dau", explain=profile) as query_profile:
+        result = await run_analytics(
+            request, query_router.serve_dau, db, from_, to, filter_params, zone
+        )
+    return render_stats(request, result, query_profile if profile else None)
 
 
 @app.get("/stats/top-events")
 @limiter.limit("60/minute")
-def get_top_events(
+async def get_top_events(
     request: Request,
     from_: date = Query(..., alias="from"),
     to: date = Query(...),
-    limit: int = 10,
+    limit: int = Query(10, ge=1, le=MAX_TOP_EVENTS_LIMIT),
+    tz: Optional[str] = Query(
+        None, description="IANA timezone for day boundaries, e.g. 'Europe/Kyiv'"
+    ),
+    profile: bool = Query(
+        False, description="Return per-phase timings, SQL and DuckDB query plans"
+    ),
     db: Session = Depends(get_db),
 ):
     """
@@ -186,43 +330,54 @@ def get_top_events(
 
     Query Parameters:
       - from: start date (inclusive)
-      - to: end date (inclusive)
-      - limit: maximum number of event types to return (default = 10)
+      - to: end date (inclusive), at most 366 days after 'from'
+      - limit: maximum number of event types to return (default = 10, max = 100)
+      - tz: IANA timezone whose local days bound the range (see /stats/dau)
+      - profile: if true, include a query profile (see /stats/dau)
 
     Returns a list of top event types with their occurrence counts.
+    Supports the same response formats as /stats/dau.
     """
 
-    try:
-        duck_res = crud.get_top_events_duck(from_, to, limit)
-        if duck_res:
-            return duck_res
-    except Exception as e:
-        logger.warning(f"Top-events DuckDB failed: {e}")
-
-    return crud.get_top_events(db, from_, to, limit)
+    check_date_range(from_, to)
+    zone = check_timezone(tz, from_, to)
+    with profile_request("/stats/top-events", explain=profile) as query_profile:
+        result = await run_analytics(
+            request, query_router.serve_top_events, db, from_, to, limit, zone
+        )
+    return render_stats(request, result, query_profile if profile else None)
 
 
 @app.get("/stats/retention")
 @limiter.limit("60/minute")
-def get_retention(
-    request: Request, start_date: date, windows: int, db: Session = Depends(get_db)
+async def get_retention(
+    request: Request,
+    start_date: date,
+    windows: int = Query(..., ge=1, le=MAX_RETENTION_WINDOWS),
+    tz: Optional[str] = Query(
+        None, description="IANA timezone for day boundaries, e.g. 'Europe/Kyiv'"
+    ),
+    profile: bool = Query(
+        False, description="Return per-phase timings, SQL and DuckDB query plans"
+    ),
+    db: Session = Depends(get_db),
 ):
     """
     Calculate simple cohort retention over time.
 
     Query Parameters:
       - start_date: the start of the first cohort window
-      - windows: number of daily or weekly retention windows to calculate
+      - windows: number of daily retention windows to calculate (max = 90)
+      - tz: IANA timezone whose local days form the windows (see /stats/dau)
+      - profile: if true, include a query profile (see /stats/dau)
 
     Returns a retention table showing how many users returned in each window.
+    Supports the same response formats as /stats/dau.
     """
 
-    try:
-        duck_res = crud.get_retention_duck(start_date, windows)
-
-        if duck_res:
-            return duck_res
-    except Exception as e:
-        logger.warning(f"Retention DuckDB failed: {e}")
-
-    return crud.get_retention(db, start_date, windows)
+    zone = check_timezone(tz, start_date, start_date + timedelta(days=windows - 1))
+    with profile_request("/stats/retention", explain=profile) as query_profile:
+        result = await run_analytics(
+            request, query_router.serve_retention, db, start_date, windows, zone
+        )
+    return render_stats(request, result, query_profile if profile else None)
@@ -0,0 +1,221 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.logger import logger
+
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 1000))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "0") == "1"
+
+
+def _jsonable(value: Any) -> Any:
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    return str(value)
+
+
+class QueryProfile:
+    """
+    Phase timings and executed queries collected while serving one
+    stats request. Shard queries add to it from several threads.
+
+    Every stats request gets one for the slow-query log; the SQL and
+    params of its queries are only kept when it is `detailed` (asked for
+    with profile=1) or for queries slower than SLOW_QUERY_MS.
+    """
+
+    def __init__(self, endpoint: str, explain: bool = False, detailed: bool = False):
+        self.endpoint = endpoint
+        self.explain = explain
+        self.detailed = detailed
+        self.paths: List[str] = []
+        self.phases: Dict[str, float] = {}
+        self.queries: List[dict] = []
+        self.total_ms = 0.0
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_phase(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds * 1000
+
+    def add_query(self, sql: str, params: Any, ms: float, **entry):
+        entry["ms"] = ms
+        if self.detailed or ms >= SLOW_QUERY_MS:
+            entry.update(sql=" ".join(sql.split()), params=params)
+        with self._lock:
+            self.queries.append(entry)
+
+    def served_by(self, path: str):
+        with self._lock:
+            self.paths.append(path)
+
+    def finish(self):
+        self.total_ms = (time.perf_counter() - self._started) * 1000
+
+    def to_dict(self) -> dict:
+        """
+        Phase times are summed over all threads, so with several shards
+        they can add up to more than the request's wall time.
+        """
+
+        return {
+            "endpoint": self.endpoint,
+            "served_by": self.paths,
+            "total_ms": round(self.total_ms, 3),
+            "phases_ms": {k: round(v, 3) for k, v in self.phases.items()},
+            "queries": [_jsonable(query) for query in self.queries],
+        }
+
+
+current_profile: ContextVar[Optional[QueryProfile]] = ContextVar(
+    "current_profile", default=None
+)
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Time a block as the named phase of the current request's profile.
+    """
+
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_phase(name, time.perf_counter() - start)
+
+
+def served_by(path: str):
+    """
+    Record which path (duckdb, oltp_tail, sql_fallback, ...) answered.
+    """
+
+    profile = current_profile.get()
+    if profile is not None:
+        profile.served_by(path)
+
+
+@contextmanager
+def profile_request(endpoint: str, explain: bool = False):
+    """
+    Profile the stats request served inside the block. Requests slower
+    than SLOW_QUERY_MS are written to the slow-query log.
+
+    With `explain` (or SLOW_QUERY_EXPLAIN) every DuckDB query also
+    records its operator plan with timings and rows scanned.
+    """
+
+    profile = QueryProfile(
+        endpoint, explain=explain or SLOW_QUERY_EXPLAIN, detailed=explain
+    )
+    token = current_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        current_profile.reset(token)
+        profile.finish()
+        if profile.total_ms >= SLOW_QUERY_MS:
+            logger.warning(
+                json.dumps({"level": "WARNING", "slow_query": profile.to_dict()})
+            )
+
+
+def render_duck_plan(profile: dict) -> dict:
+    """
+    Summarize DuckDB's JSON query profile: planning time, rows scanned and
+    the operator tree as EXPLAIN ANALYZE shows it, one line per operator.
+    """
+
+    lines = []
+
+    def walk(node: dict, depth: int):
+        extra = "; ".join(f"{k}: {v}" for k, v in node.get("extra_info", {}).items())
+        lines.append(
+            f"{'  ' * depth}{node['operator_name'].strip()}"
+            f"  rows={node['operator_cardinality']}"
+            f"  scanned={node['operator_rows_scanned']}"
+            f"  {node['operator_timing'] * 1000:.3f}ms"
+            + (f"  [{extra}]" if extra else "")
+        )
+        for child in node["children"]:
+            walk(child, depth + 1)
+
+    for child in profile["children"]:
+        walk(child, 0)
+
+    planning = (
+        profile.get("planner", 0)
+        + profile.get("physical_planner", 0)
+        + profile.get("all_optimizers", 0)
+    )
+    return {
+        "planning_ms": round(planning * 1000, 3),
+        "cpu_ms": round(profile["cpu_time"] * 1000, 3),
+        "rows_scanned": profile["cumulative_rows_scanned"],
+        "plan": lines,
+    }
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_profile.get() is not None:
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile.get()
+    if profile is None or not conn.info.get("profile_started"):
+        return
+
+    elapsed = time.perf_counter() - conn.info["profile_started"].pop()
+    profile.add_phase("oltp_query", elapsed)
+    profile.add_query(
+        store="oltp",
+        sql=statement,
+        params=parameters,
+        ms=round(elapsed * 1000, 3),
+    )
+
+
+# Inserted ahead of other handle_error listeners: the analytics guards
+# raise from theirs, which would skip this one and leave a stale start.
+@event.listens_for(Engine, "handle_error", insert=True)
+def _failed_cursor_execute(context):
+    conn = context.connection
+    if conn is None or not conn.info.get("profile_started"):
+        return
+
+    elapsed = time.perf_counter() - conn.info["profile_started"].pop()
+    profile = current_profile.get()
+    if profile is None:
+        return
+    profile.add_phase("oltp_query", elapsed)
+    profile.add_query(
+        store="oltp",
+        sql=context.statement,
+        params=context.parameters,
+        ms=round(elapsed * 1000, 3),
+        error=repr(context.original_exception),
+    )
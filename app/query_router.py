@@ -0,0 +1,374 @@
+from datetime import date, timedelta
+from typing import Dict, Optional
+from zoneinfo import ZoneInfo
+
+from sqlalchemy.orm import Session
+
+import app.crud as crud
+import app.realtime as realtime
+from app.db.duck import QueryCancelled, ShardCountMismatch, get_sync_watermark
+from app.logger import logger
+from app.profiling import phase, served_by
+from app.responses import StatsResult
+from app.timezones import hour_day_map, local_day_bounds
+
+
+def get_dau(
+    db: Session,
+    from_: date,
+    to: date,
+    filter_params: Optional[Dict] = None,
+    tz: Optional[ZoneInfo] = None,
+) -> StatsResult:
+    """
+    Get Daily Active Users per day.
+
+    Today's count comes from the live counters when they are complete and
+    no segment filter is applied; other days, and today as soon as the
+    counters are unavailable, come from the stored data. With `tz`, days
+    are local days in that zone, built from the hourly rollups; the live
+    counters only cover UTC days and are not used.
+    """
+
+    if tz is not None:
+        counts = _get_local_dau(db, from_, to, tz)
+        days = sorted(counts)
+        return StatsResult({"day": days, "count": [counts[day] for day in days]})
+
+    today = realtime.today()
+    live = None
+    if filter_params is None and from_ <= today <= to:
+        with phase("realtime"):
+            live = realtime.get_dau(today)
+
+    if live is None:
+        counts = _get_stored_dau(db, from_, to, filter_params)
+    else:
+        served_by("realtime")
+        counts = {}
+        for start, end in _around(from_, to, today):
+            counts.update(_get_stored_dau(db, start, end, filter_params))
+        if live:
+            counts[today] = live
+
+    days = sorted(counts)
+    return StatsResult({"day": days, "count": [counts[day] for day in days]})
+
+
+def _around(from_: date, to: date, day: date):
+    """
+    Split [from_, to] into the ranges before and after `day`.
+    """
+
+    ranges = []
+    if from_ < day:
+        ranges.append((from_, day - timedelta(days=1)))
+    if day < to:
+        ranges.append((day + timedelta(days=1), to))
+    return ranges
+
+
+def _get_stored_dau(
+    db: Session, from_: date, to: date, filter_params: Optional[Dict]
+) -> Dict[date, int]:
+    """
+    Get Daily Active Users from DuckDB up to the sync watermark, adding the
+    not-yet-synced tail from the OLTP store.
+
+    Days before the watermark day come straight from DuckDB. The watermark
+    day is split between both stores, so its users are merged as sets;
+    later days exist only in the OLTP tail.
+    """
+
+    watermark = get_sync_watermark()
+    counts: Dict[date, int] = {}
+    users: Dict[date, set] = {}
+
+    if watermark is not None:
+        served_by("duckdb")
+        boundary = watermark.date()
+        last_full_day = min(to, boundary - timedelta(days=1))
+        if last_full_day >= from_:
+            counts.update(crud.get_dau_duck(from_, last_full_day, filter_params))
+        if from_ <= boundary <= to:
+            users[boundary] = crud.get_day_users_duck(boundary, filter_params)
+
+    if watermark is None or watermark.date() <= to:
+        served_by("oltp_tail")
+        with phase("oltp_tail"):
+            tail = crud.get_tail_day_users(db, watermark, from_, to, filter_params)
+        for day, day_users in tail.items():
+            users.setdefault(day, set()).update(day_users)
+
+    for day, day_users in users.items():
+        if day_users:
+            counts[day] = len(day_users)
+
+    return counts
+
+
+def _get_local_dau(db: Session, from_: date, to: date, tz: ZoneInfo) -> Dict[date, int]:
+    """
+    Get Daily Active Users per local day in `tz`.
+
+    Local days that ended before the watermark are merged from the UTC
+    hourly rollups in DuckDB. The day the watermark falls in is split
+    between the rollups and the OLTP tail, so its users are merged as
+    sets; later days exist only in the OLTP tail.
+    """
+
+    bounds = local_day_bounds(from_, to, tz)
+    watermark = get_sync_watermark()
+    counts: Dict[date, int] = {}
+    users: Dict[date, set] = {}
+
+    if watermark is not None:
+        served_by("duckdb_hourly")
+        synced = {day: b for day, b in bounds.items() if b[1] <= watermark}
+        if synced:
+            counts.update(crud.get_dau_hourly(*hour_day_map(synced)))
+        for day, (start, end) in bounds.items():
+            if start <= watermark < end:
+                users[day] = crud.get_users_hourly(start, end)
+
+    if watermark is None or watermark < bounds[to][1]:
+        served_by("oltp_tail")
+        with phase("oltp_tail"):
+            tail = crud.get_local_day_users(db, watermark, bounds, tz)
+        for day, day_users in tail.items():
+            users.setdefault(day, set()).update(day_users)
+
+    for day, day_users in users.items():
+        if day_users:
+            counts[day] = len(day_users)
+
+    return counts
+
+
+def get_top_events(
+    db: Session,
+    from_: date,
+    to: date,
+    limit: int = 10,
+    tz: Optional[ZoneInfo] = None,
+) -> StatsResult:
+    """
+    Get the most frequent event types.
+
+    Today's counts come from the live counters when they are complete,
+    the rest of the range from the stored data. With `tz`, the range is
+    in local days and is served from the hourly rollups instead.
+    """
+
+    if tz is not None:
+        counts = _get_local_event_counts(db, from_, to, tz)
+    else:
+        counts = _get_event_counts(db, from_, to)
+
+    top = sorted(counts, key=counts.get, reverse=True)[:limit]
+    return StatsResult(
+        {"event_type": top, "count": [counts[event_type] for event_type in top]}
+    )
+
+
+def _get_event_counts(db: Session, from_: date, to: date) -> Dict[str, int]:
+    today = realtime.today()
+    live = None
+    if from_ <= today <= to:
+        with phase("realtime"):
+            live = realtime.get_event_counts(today)
+
+    if live is None:
+        return _get_stored_event_counts(db, from_, to)
+
+    served_by("realtime")
+    counts = live
+    for start, end in _around(from_, to, today):
+        for event_type, count in _get_stored_event_counts(db, start, end).items():
+            counts[event_type] = counts.get(event_type, 0) + count
+    return counts
+
+
+def _get_stored_event_counts(db: Session, from_: date, to: date) -> Dict[str, int]:
+    """
+    Count events per type, summing DuckDB counts up to the sync watermark
+    with counts from the OLTP tail.
+
+    DuckDB is cut off at the watermark explicitly: a shard that synced
+    further than the others must not count events the tail counts too.
+    """
+
+    watermark = get_sync_watermark()
+    counts: Dict[str, int] = {}
+
+    if watermark is not None and watermark.date() >= from_:
+        served_by("duckdb")
+        counts.update(crud.get_top_events_duck(from_, to, limit=None, until=watermark))
+
+    if watermark is None or watermark.date() <= to:
+        served_by("oltp_tail")
+        with phase("oltp_tail"):
+            tail = crud.get_tail_event_counts(db, watermark, from_, to)
+        for event_type, count in tail.items():
+            counts[event_type] = counts.get(event_type, 0) + count
+
+    return counts
+
+
+def _get_local_event_counts(
+    db: Session, from_: date, to: date, tz: ZoneInfo
+) -> Dict[str, int]:
+    """
+    Count events per type over the local days [from_, to] in `tz`, from
+    the hourly rollups up to the watermark plus the OLTP tail after it.
+    """
+
+    bounds = local_day_bounds(from_, to, tz)
+    start, end = bounds[from_][0], bounds[to][1]
+    watermark = get_sync_watermark()
+    counts: Dict[str, int] = {}
+
+    if watermark is not None and watermark >= start:
+        served_by("duckdb_hourly")
+        counts.update(crud.get_event_counts_hourly(start, end, watermark))
+
+    if watermark is None or watermark < end:
+        served_by("oltp_tail")
+        with phase("oltp_tail"):
+            tail = crud.get_event_counts_between(db, watermark, start, end)
+        for event_type, count in tail.items():
+            counts[event_type] = counts.get(event_type, 0) + count
+
+    return counts
+
+
+def get_retention(
+    db: Session, start_date: date, windows: int = 3, tz: Optional[ZoneInfo] = None
+) -> StatsResult:
+    """
+    Get active users per daily window starting at `start_date`.
+    """
+
+    end_date = start_date + timedelta(days=windows - 1)
+    dau = get_dau(db, start_date, end_date, tz=tz).columns
+    active = dict(zip(dau["day"], dau["count"]))
+
+    return StatsResult(
+        {
+            "window": list(range(1, windows + 1)),
+            "active_users": [
+                active.get(start_date + timedelta(days=i), 0) for i in range(windows)
+            ],
+        }
+    )
+
+
+def serve_dau(
+    db: Session,
+    from_: date,
+    to: date,
+    filter_params: Optional[Dict] = None,
+    tz: Optional[ZoneInfo] = None,
+) -> StatsResult:
+    """
+    Serve DAU from the hybrid path, falling back to a full SQL query if
+    DuckDB fails. Timeouts and cancellations are not retried on SQL, nor
+    is a shard count mismatch: the OLTP store lacks archived history.
+    The fallback result uses the same columns as the hybrid one.
+    """
+
+    try:
+        return get_dau(db, from_, to, filter_params, tz)
+    except (QueryCancelled, ShardCountMismatch):
+        raise
+    except Exception as e:
+        logger.warning(f"DuckDB DAU failed, fallback to SQL: {e}")
+
+    served_by("sql_fallback")
+    if tz is not None:
+        with phase("sql_fallback"):
+            users = _get_local_users(db, from_, to, tz)
+        days = sorted(users)
+        return StatsResult({"day": days, "count": [len(users[d]) for d in days]})
+
+    with phase("sql_fallback"):
+        rows = crud.get_dau(db, from_, to, filter_params)
+    return StatsResult(
+        {
+            "day": [date.fromisoformat(str(r["date"])) for r in rows],
+            "count": [r["dau"] for r in rows],
+        }
+    )
+
+
+def _get_local_users(db: Session, from_: date, to: date, tz: ZoneInfo):
+    return crud.get_local_day_users(db, None, local_day_bounds(from_, to, tz), tz)
+
+
+def serve_top_events(
+    db: Session,
+    from_: date,
+    to: date,
+    limit: int = 10,
+    tz: Optional[ZoneInfo] = None,
+) -> StatsResult:
+    try:
+        return get_top_events(db, from_, to, limit, tz)
+    except (QueryCancelled, ShardCountMismatch):
+        raise
+    except Exception as e:
+        logger.warning(f"Top-events DuckDB failed: {e}")
+
+    served_by("sql_fallback")
+    if tz is not None:
+        bounds = local_day_bounds(from_, to, tz)
+        with phase("sql_fallback"):
+            counts = crud.get_event_counts_between(
+                db, None, bounds[from_][0], bounds[to][1]
+            )
+        top = sorted(counts, key=counts.get, reverse=True)[:limit]
+        return StatsResult({"event_type": top, "count": [counts[t] for t in top]})
+
+    with phase("sql_fallback"):
+        rows = crud.get_top_events(db, from_, to, limit)
+    return StatsResult(
+        {
+            "event_type": [r["event_type"] for r in rows],
+            "count": [r["count"] for r in rows],
+        }
+    )
+
+
+def serve_retention(
+    db: Session, start_date: date, windows: int = 3, tz: Optional[ZoneInfo] = None
+) -> StatsResult:
+    try:
+        return get_retention(db, start_date, windows, tz)
+    except (QueryCancelled, ShardCountMismatch):
+        raise
+    except Exception as e:
+        logger.warning(f"Retention DuckDB failed: {e}")
+
+    served_by("sql_fallback")
+    if tz is not None:
+        end_date = start_date + timedelta(days=windows - 1)
+        with phase("sql_fallback"):
+            users = _get_local_users(db, start_date, end_date, tz)
+        return StatsResult(
+            {
+                "window": list(range(1, windows + 1)),
+                "active_users": [
+                    len(users.get(start_date + timedelta(days=i), ()))
+                    for i in range(windows)
+                ],
+            }
+        )
+
+    with phase("sql_fallback"):
+        rows = crud.get_retention(db, start_date, windows)
+    return StatsResult(
+        {
+            "window": [r["window"] for r in rows],
+            "active_users": [r["active_users"] for r in rows],
+        }
+    )
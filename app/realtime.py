@@ -0,0 +1,157 @@
+import os
+from datetime import date, datetime, timezone
+from typing import Dict, Iterable, Optional
+
+from app.logger import logger
+
+
+REALTIME_REDIS_URL = os.getenv("REALTIME_REDIS_URL")
+REALTIME_KEY_TTL = int(os.getenv("REALTIME_KEY_TTL", 2 * 86400))
+
+_client = None
+# Days whose counters missed events in this process, in case deleting
+# their complete marker failed too.
+_invalid_days: set = set()
+
+
+def _get_client():
+    global _client
+    if _client is None and REALTIME_REDIS_URL:
+        import redis
+
+        _client = redis.Redis.from_url(REALTIME_REDIS_URL)
+    return _client
+
+
+def today() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+def _day_of(occurred_at: datetime) -> date:
+    if occurred_at.tzinfo is None:
+        return occurred_at.date()
+    return occurred_at.astimezone(timezone.utc).date()
+
+
+def prepare_day(day: date) -> bool:
+    """
+    Mark the counters for `day` as complete. This must happen before the
+    day starts: counters first touched during the day (e.g. after a Redis
+    restart) may have missed events and are never served.
+    """
+
+    client = _get_client()
+    if client is None:
+        return False
+    client.set(f"rt:complete:{day}", 1, nx=True, ex=REALTIME_KEY_TTL)
+    return True
+
+
+def invalidate_days(days: Iterable[date]):
+    """
+    Stop serving the counters of `days`, which missed some events. The
+    complete markers are deleted so every process falls back to stored
+    data; this process also remembers the days in case Redis is down.
+    """
+
+    days = set(days)
+    if not days:
+        return
+    _invalid_days.update(days)
+
+    client = _get_client()
+    if client is None:
+        return
+    try:
+        client.delete(*(f"rt:complete:{day}" for day in days))
+    except Exception as e:
+        logger.warning(f"Failed to invalidate realtime counters for {days}: {e}")
+
+
+def invalidate_events(events: Iterable):
+    """
+    Invalidate the days of events that may have been stored without
+    reaching the counters, e.g. when a worker died between the commit and
+    record_events.
+    """
+
+    invalidate_days({_day_of(ev.occurred_at) for ev in events})
+
+
+def record_events(events: Iterable) -> bool:
+    """
+    Add newly stored events to the live per-day counters: a HyperLogLog of
+    user_ids and a sorted set of counts per event_type, keyed by UTC day.
+
+    Only events that were actually inserted must be passed, so duplicates
+    are never counted. Returns False if the counters are disabled or
+    Redis is unavailable; ingestion does not fail because of them, but
+    the days involved are invalidated rather than served undercounted.
+    """
+
+    client = _get_client()
+    if client is None:
+        return False
+
+    users: Dict[date, set] = {}
+    types: Dict[date, Dict[str, int]] = {}
+    for ev in events:
+        day = _day_of(ev.occurred_at)
+        users.setdefault(day, set()).add(ev.user_id)
+        counts = types.setdefault(day, {})
+        counts[ev.event_type] = counts.get(ev.event_type, 0) + 1
+    if not users:
+        return True
+
+    try:
+        pipe = client.pipeline(transaction=False)
+        for day, day_users in users.items():
+            pipe.pfadd(f"rt:dau:{day}", *day_users)
+            for event_type, count in types[day].items():
+                pipe.zincrby(f"rt:top:{day}", count, event_type)
+            pipe.expire(f"rt:dau:{day}", REALTIME_KEY_TTL)
+            pipe.expire(f"rt:top:{day}", REALTIME_KEY_TTL)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Failed to update realtime counters: {e}")
+        invalidate_days(users)
+        return False
+    return True
+
+
+def _read(day: date, command: str, *args, **kwargs):
+    client = _get_client()
+    if client is None or day in _invalid_days:
+        return None
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.exists(f"rt:complete:{day}")
+        getattr(pipe, command)(*args, **kwargs)
+        complete, value = pipe.execute()
+    except Exception as e:
+        logger.warning(f"Realtime counters unavailable: {e}")
+        return None
+    return value if complete else None
+
+
+def get_dau(day: date) -> Optional[int]:
+    """
+    Approximate distinct users for `day` (HyperLogLog, ~0.8% standard
+    error), or None if the live counters are not available.
+    """
+
+    return _read(day, "pfcount", f"rt:dau:{day}")
+
+
+def get_event_counts(day: date) -> Optional[Dict[str, int]]:
+    """
+    Event counts per type for `day`, or None if not available.
+    """
+
+    rows = _read(day, "zrange", f"rt:top:{day}", 0, -1, withscores=True)
+    if rows is None:
+        return None
+    return {
+        (name.decode() if isinstance(name, bytes) else name): int(score)
+        for name, score in rows
+    }
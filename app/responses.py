@@ -0,0 +1,73 @@
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import orjson
+import pyarrow as pa
+from fastapi import Request, Response
+
+from app.profiling import QueryProfile
+
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+COLUMNAR_JSON_MEDIA_TYPE = "application/vnd.events.columnar+json"
+ROWS_JSON_MEDIA_TYPE = "application/vnd.events.rows+json"
+
+
+class StatsResult(NamedTuple):
+    """
+    Result of a stats query, kept column by column.
+    """
+
+    columns: Dict[str, list]
+
+    def records(self) -> List[Dict]:
+        names = list(self.columns)
+        return [dict(zip(names, values)) for values in zip(*self.columns.values())]
+
+    def rows(self) -> List[Tuple]:
+        return list(zip(*self.columns.values()))
+
+    def to_json(self) -> Dict:
+        return {"columns": list(self.columns), "rows": self.rows()}
+
+
+def render_stats(
+    request: Request, result: StatsResult, profile: Optional[QueryProfile] = None
+) -> Response:
+    """
+    Serialize a stats result according to the Accept header:
+      - application/vnd.apache.arrow.stream: Arrow IPC stream
+      - application/vnd.events.columnar+json: {"column": [values, ...], ...}
+      - application/vnd.events.rows+json: {"columns": [names],
+        "rows": [[values], ...]}
+      - anything else: JSON array of records
+
+    With a profile, the response is always JSON: {"data": [records],
+    "profile": {...}}.
+
+    Every format is encoded directly, skipping FastAPI's jsonable_encoder.
+    The columnar, rows and Arrow formats also skip building a dict per
+    row, which makes them the cheaper choice for large results.
+    """
+
+    if profile is not None:
+        body = {"data": result.records(), "profile": profile.to_dict()}
+        return Response(orjson.dumps(body), media_type="application/json")
+
+    accept = request.headers.get("accept", "")
+
+    if ARROW_MEDIA_TYPE in accept:
+        sink = pa.BufferOutputStream()
+        table = pa.table(result.columns)
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return Response(sink.getvalue().to_pybytes(), media_type=ARROW_MEDIA_TYPE)
+
+    if COLUMNAR_JSON_MEDIA_TYPE in accept:
+        return Response(
+            orjson.dumps(result.columns), media_type=COLUMNAR_JSON_MEDIA_TYPE
+        )
+
+    if ROWS_JSON_MEDIA_TYPE in accept:
+        return Response(orjson.dumps(result.to_json()), media_type=ROWS_JSON_MEDIA_TYPE)
+
+    return Response(orjson.dumps(result.records()), media_type="application/json")
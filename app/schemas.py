@@ -2,7 +2,7 @@ from datetime import datetime, date
 from uuid import UUID
 from typing import Any, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class TaskResponse(BaseModel):
@@ -12,10 +12,29 @@ class TaskResponse(BaseModel):
     count: int
 
 
+class TaskReceipt(BaseModel):
+
+    created: int
+    duplicates: int
+    rejected: int
+    ttl: int = Field(..., description="Seconds until the result expires")
+
+
 class TaskStatus(BaseModel):
 
     task_id: str
     status: str
+    receipt: Optional[TaskReceipt] = None
+
+
+class TaskStatusRequest(BaseModel):
+
+    task_ids: list[str] = Field(..., min_length=1, max_length=1000)
+
+
+class TaskStatusBatch(BaseModel):
+
+    results: list[TaskStatus]
 
 
 class EventBase(BaseModel):
@@ -0,0 +1,48 @@
+from typing import Dict, List
+
+from celery import states
+
+
+MGET_CHUNK_SIZE = 500
+
+
+def get_task_statuses(celery_app, task_ids: List[str]) -> List[Dict]:
+    """
+    Look up the state of many Celery tasks with pipelined Redis reads.
+
+    Result keys are fetched in MGET chunks sent through a single pipeline,
+    so polling thousands of tasks costs one round trip instead of one
+    GET per task. Tasks without a stored result are reported as PENDING.
+
+    The same pipeline reads each key's PTTL, so a receipt's `ttl` is the
+    number of seconds left before the result expires.
+    """
+
+    backend = celery_app.backend
+    keys = [backend.get_key_for_task(task_id) for task_id in task_ids]
+
+    pipe = backend.client.pipeline(transaction=False)
+    for i in range(0, len(keys), MGET_CHUNK_SIZE):
+        pipe.mget(keys[i : i + MGET_CHUNK_SIZE])
+    for key in keys:
+        pipe.pttl(key)
+    replies = pipe.execute()
+    chunks = -(-len(keys) // MGET_CHUNK_SIZE)
+    values = [value for chunk in replies[:chunks] for value in chunk]
+    ttls = replies[chunks:]
+
+    statuses = []
+    for task_id, value, pttl in zip(task_ids, values, ttls):
+        if not value:
+            statuses.append({"task_id": task_id, "status": states.PENDING})
+            continue
+
+        meta = backend.decode_result(value)
+        item = {"task_id": task_id, "status": meta["status"]}
+        if meta["status"] == states.SUCCESS and isinstance(meta["result"], dict):
+            item["receipt"] = dict(meta["result"])
+            if pttl >= 0:
+                item["receipt"]["ttl"] = pttl // 1000
+        statuses.append(item)
+
+    return statuses
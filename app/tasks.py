@@ -1,83 +1,440 @@
 import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import repeat
+from typing import Optional
+
+import duckdb
+import pyarrow as pa
 import pytz
 
 from celery import shared_task
+from pydantic import ValidationError
 
-from app import schemas, crud
-from app.db.db_depends import get_db
-from app.db.engine import SessionLocal
-from app.db.duck import write_analytics, get_duck_conn
-from app.db.models import Event
+from app import schemas, crud, realtime
+from app.db.archive import ARCHIVE_AFTER_DAYS, archive_events, compact_store
+from app.db.engine import WriteSessionLocal, write_engine
+from app.db.duck import (
+    ANALYTICS_SHARDS,
+    check_shard_count,
+    check_shard_files,
+    get_duck_conn,
+    publish_snapshot,
+    shard_for,
+    snapshot_is_stale,
+)
+from app.ingest_log import (
+    INGEST_LOG_MAX_REDELIVERIES,
+    INGEST_LOG_REDELIVER_AFTER,
+    get_ingest_log,
+)
+from app.logger import logger
 
 
-@shared_task(autoretry_for=(Exception,), retry_backoff=True, max_retries=3)
-def create_events_task(events_data: list[dict]):
+RESULT_TTL_SECONDS = int(os.getenv("TASK_RESULT_TTL_SECONDS", 3600))
+
+
+def _parse_events(events_data: list[dict]):
+    events, rejected = [], 0
+    for e in events_data:
+        try:
+            events.append(schemas.EventCreate(**e))
+        except ValidationError:
+            rejected += 1
+    return events, rejected
+
+
+def apply_events(events_data: list[dict], redelivered: bool = False) -> dict:
     """
-    Celery task for creating events asynchronously.
+    Write a batch of events to the OLTP store and return its receipt.
     Ignores duplicates (idempotent behavior).
+
+    A redelivered batch may have been committed by a worker that died
+    before updating the live counters, so if it turns out to hold
+    duplicates the counters of its days are invalidated.
     """
 
-    db = SessionLocal()
+    events, rejected = _parse_events(events_data)
+
+    db = WriteSessionLocal()
     try:
-        events = [schemas.EventCreate(**e) for e in events_data]
         created = crud.create_events(db, events)
         db.commit()
-        return [str(ev.event_id) for ev in created]
+        realtime.record_events(created)
+        if redelivered and len(created) < len(events):
+            realtime.invalidate_events(events)
+        return {
+            "created": len(created),
+            "duplicates": len(events) - len(created),
+            "rejected": rejected,
+            "ttl": RESULT_TTL_SECONDS,
+        }
     finally:
         db.close()
 
 
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, max_retries=3)
+def create_events_task(log_offset: int):
+    """
+    Celery task applying one ingest log record to the OLTP store.
+
+    Returns a compact receipt with counts instead of the created IDs,
+    so result payloads stay small no matter how big the batch is.
+    """
+
+    ingest_log = get_ingest_log()
+    record = ingest_log.read_at(log_offset)
+    receipt = apply_events(record.events)
+    ingest_log.ack("oltp", record.offset, record.next_offset)
+    return receipt
+
+
+def _queued_tasks() -> int:
+    """
+    Return how many messages are waiting in the broker's default queue.
+    """
+
+    app = create_events_task.app
+    with app.connection_for_read() as conn:
+        return conn.default_channel.client.llen(app.conf.task_default_queue)
+
+
+@shared_task
+def redeliver_ingest_log():
+    """
+    Apply ingest log records whose create_events_task never finished,
+    e.g. because the broker lost it or it ran out of retries.
+
+    Nothing is redelivered while tasks are waiting in the broker queue:
+    their records are late rather than lost, and applying them here as
+    well would double the work on a backlog.
+
+    A record that fails is logged and skipped, so it does not block the
+    ones after it. After INGEST_LOG_MAX_REDELIVERIES failed runs it is
+    moved to the dead-letter file and acked.
+    """
+
+    queued = _queued_tasks()
+    if queued:
+        return f"{queued} tasks still queued, not redelivering"
+
+    ingest_log = get_ingest_log()
+    redelivered = failed = 0
+    for record in ingest_log.unacked("oltp", time.time() - INGEST_LOG_REDELIVER_AFTER):
+        try:
+            apply_events(record.events, redelivered=True)
+        except Exception as e:
+            failed += 1
+            logger.exception(f"Failed to redeliver ingest log record {record.offset}")
+            if ingest_log.fail("oltp", record, repr(e)):
+                logger.error(
+                    f"Dead-lettered ingest log record {record.offset} after "
+                    f"{INGEST_LOG_MAX_REDELIVERIES} failed redeliveries"
+                )
+            continue
+        ingest_log.ack("oltp", record.offset, record.next_offset)
+        redelivered += 1
+
+    if redelivered:
+        logger.warning(f"Redelivered {redelivered} ingest log records")
+    return f"Redelivered {redelivered} records, {failed} failed"
+
+
+@shared_task
+def prepare_realtime_counters():
+    """
+    Mark tomorrow's live counters as complete before the day starts, so
+    the stats endpoints may serve that day from them.
+    """
+
+    tomorrow = realtime.today() + timedelta(days=1)
+    realtime.prepare_day(tomorrow)
+    return f"Prepared realtime counters for {tomorrow}"
+
+
 @shared_task(autoretry_for=(Exception,), retry_backoff=True, max_retries=3)
 def sync_events_to_duck():
     """
-    Sync Events from SQL to DuckDB using batch insert.
+    Load new ingest log records into DuckDB.
+
+    The log offset is stored in DuckDB in the same transaction as the rows,
+    so a failed run is replayed from where the last one committed. Events
+    already loaded are skipped by event_id.
+
+    With ANALYTICS_SHARDS > 1 each chunk is split by user and the shards are
+    written in parallel. Every shard records the same offset and watermark,
+    and the shard count: files laid out for another count are refused with
+    ShardCountMismatch until cli.reshard has redistributed them.
+
+    Writes go to the working DuckDB files only; readers switch to the new
+    data once publish_analytics_snapshots has published them. Until then
+    the stats endpoints serve it from the OLTP tail, since the watermark
+    they use is read from the published snapshot.
     """
 
-    conn = get_duck_conn()
-    conn.execute("PRAGMA threads=1;")
+    ingest_log = get_ingest_log()
+    shards = range(ANALYTICS_SHARDS)
+    synced = [0 for _ in shards]
+    check_shard_files()
+
+    with ThreadPoolExecutor(max_workers=ANALYTICS_SHARDS) as pool:
+        conns = [get_duck_conn(shard=shard) for shard in shards]
+        try:
+            for conn in conns:
+                conn.execute("PRAGMA threads=1;")
+                _create_analytics_tables(conn)
+                check_shard_count(_shard_count(conn))
+
+            # A shard left behind by a failed run catches up from its own
+            # offset; the others ignore the events they already have.
+            offset = min(_log_offset(conn) for conn in conns)
 
+            for records in ingest_log.scan(offset):
+                by_shard, watermark = _split_records(records)
+                offset = records[-1].next_offset
+                loaded = pool.map(
+                    _load_events, conns, by_shard, repeat(watermark), repeat(offset)
+                )
+                synced = [a + b for a, b in zip(synced, loaded)]
+                ingest_log.commit("analytics", offset)
+
+            for conn in conns:
+                conn.execute("CHECKPOINT")
+        finally:
+            for conn in conns:
+                conn.close()
+
+    if not sum(synced):
+        return "No new events"
+    return f"Synced {sum(synced)} events"
+
+
+@shared_task
+def publish_analytics_snapshots():
+    """
+    Publish the shards whose working DuckDB file changed since their last
+    snapshot.
+
+    Runs on its own ANALYTICS_PUBLISH_SECONDS schedule instead of after
+    every sync, so the files are copied at that cadence at most and only
+    when the loader has written to them. A shard the loader holds open is
+    left for the next run.
+    """
+
+    published = 0
+    for shard in range(ANALYTICS_SHARDS):
+        if not snapshot_is_stale(shard):
+            continue
+        try:
+            publish_snapshot(shard)
+        except (duckdb.IOException, duckdb.ConnectionException) as e:
+            logger.info(f"Shard {shard} is being written, not publishing: {e}")
+            continue
+        published += 1
+
+    return f"Published {published} snapshots"
+
+
+def _create_analytics_tables(conn):
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS events (
             user_id INTEGER,
             occurred_at TIMESTAMP,
             event_type TEXT,
-            properties JSON
+            properties JSON,
+            event_id UUID
         )
     """
     )
+    # Files created before the ingest log have no event_id column yet.
+    conn.execute("ALTER TABLE events ADD COLUMN IF NOT EXISTS event_id UUID")
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS events_event_id ON events (event_id)"
+    )
 
-    last_ts = conn.execute(
-        "SELECT COALESCE(MAX(occurred_at), TIMESTAMP '1970-01-01') FROM events"
-    ).fetchone()[0]
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name TEXT PRIMARY KEY,
+            watermark TIMESTAMP,
+            log_offset BIGINT
+        )
+    """
+    )
+    conn.execute("ALTER TABLE sync_state ADD COLUMN IF NOT EXISTS log_offset BIGINT")
+    conn.execute("ALTER TABLE sync_state ADD COLUMN IF NOT EXISTS shards INTEGER")
 
-    db = next(get_db())
-    try:
-        new_events = (
-            db.query(Event)
-            .filter(Event.occurred_at > last_ts)
-            .order_by(Event.occurred_at)
-            .all()
+    # Hourly rollups in UTC, merged into local days for any whole-hour
+    # timezone. Files that predate them are backfilled once from events.
+    tables = {
+        row[0]
+        for row in conn.execute("SELECT table_name FROM duckdb_tables()").fetchall()
+    }
+    if "events_hourly" not in tables:
+        conn.execute(
+            """
+            CREATE TABLE events_hourly (
+                hour TIMESTAMP,
+                event_type TEXT,
+                events BIGINT,
+                PRIMARY KEY (hour, event_type)
+            )
+        """
+        )
+        conn.execute(
+            """
+            INSERT INTO events_hourly
+            SELECT date_trunc('hour', occurred_at), event_type, COUNT(*)
+            FROM events
+            GROUP BY ALL
+        """
+        )
+    if "user_hours" not in tables:
+        conn.execute(
+            """
+            CREATE TABLE user_hours (
+                hour TIMESTAMP,
+                user_id INTEGER,
+                PRIMARY KEY (hour, user_id)
+            )
+        """
+        )
+        conn.execute(
+            """
+            INSERT INTO user_hours
+            SELECT DISTINCT date_trunc('hour', occurred_at), user_id FROM events
+        """
         )
 
-        if not new_events:
-            return "No new events"
 
-        data = [
-            (
-                str(ev.user_id),
-                ev.occurred_at.astimezone(pytz.UTC).replace(tzinfo=None),
-                ev.event_type,
-                json.dumps(ev.properties) if ev.properties else None,
-            )
-            for ev in new_events
-        ]
+def _log_offset(conn) -> int:
+    row = conn.execute(
+        "SELECT log_offset FROM sync_state WHERE name = 'events'"
+    ).fetchone()
+    return row[0] if row and row[0] is not None else 0
 
-        sql = "INSERT INTO events (user_id, occurred_at, event_type, properties) VALUES (?, ?, ?, ?)"
-        write_analytics(conn, sql, data)
 
-        return f"Synced {len(new_events)} events"
+def _split_records(records):
+    """
+    Parse and dedupe the events of a chunk of log records, grouped by the
+    shard they belong to. Also returns the chunk's latest occurred_at.
+    """
+
+    events, _ = _parse_events([e for record in records for e in record.events])
+    unique = {}
+    for ev in events:
+        unique.setdefault(ev.event_id, ev)
+
+    by_shard = [[] for _ in range(ANALYTICS_SHARDS)]
+    watermark = None
+    for ev in unique.values():
+        occurred_at = ev.occurred_at.astimezone(pytz.UTC).replace(tzinfo=None)
+        by_shard[shard_for(ev.user_id)].append((ev, occurred_at))
+        if watermark is None or occurred_at > watermark:
+            watermark = occurred_at
+    return by_shard, watermark
+
+
+def _shard_count(conn) -> Optional[int]:
+    row = conn.execute("SELECT shards FROM sync_state WHERE name = 'events'").fetchone()
+    return row[0] if row else None
+
+
+def _load_events(conn, events, watermark, log_offset: int) -> int:
+    batch = pa.table(
+        {
+            "event_id": [str(ev.event_id) for ev, _ in events],
+            "user_id": pa.array([ev.user_id for ev, _ in events], pa.int32()),
+            "occurred_at": pa.array(
+                [occurred_at for _, occurred_at in events], pa.timestamp("us")
+            ),
+            "event_type": pa.array([ev.event_type for ev, _ in events], pa.string()),
+            "properties": pa.array(
+                [
+                    json.dumps(ev.properties) if ev.properties else None
+                    for ev, _ in events
+                ],
+                pa.string(),
+            ),
+        }
+    )
 
+    # The watermark and log offset move in the same transaction as the rows,
+    # so the query router never counts an event from both DuckDB and the
+    # OLTP tail, and no record is loaded twice.
+    conn.begin()
+    conn.register("batch", batch)
+    inserted = conn.execute(
+        """
+        INSERT OR IGNORE INTO events
+            (event_id, user_id, occurred_at, event_type, properties)
+        SELECT CAST(event_id AS UUID), user_id, occurred_at, event_type,
+               CAST(properties AS JSON)
+        FROM batch
+        RETURNING user_id, occurred_at, event_type
+    """
+    ).fetch_arrow_table()
+    conn.unregister("batch")
+
+    # Only rows that were actually inserted go into the rollups, so
+    # replayed events are not counted twice.
+    conn.register("inserted", inserted)
+    conn.execute(
+        """
+        INSERT INTO events_hourly
+        SELECT date_trunc('hour', occurred_at), event_type, COUNT(*)
+        FROM inserted
+        GROUP BY ALL
+        ON CONFLICT (hour, event_type)
+        DO UPDATE SET events = events_hourly.events + excluded.events
+    """
+    )
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO user_hours
+        SELECT DISTINCT date_trunc('hour', occurred_at), user_id FROM inserted
+    """
+    )
+    conn.unregister("inserted")
+    conn.execute(
+        """
+        INSERT INTO sync_state (name, watermark, log_offset, shards)
+        VALUES ('events', ?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET
+            watermark = GREATEST(sync_state.watermark, excluded.watermark),
+            log_offset = excluded.log_offset,
+            shards = excluded.shards
+    """,
+        [watermark, log_offset, ANALYTICS_SHARDS],
+    )
+    conn.commit()
+
+    return inserted.num_rows
+
+
+@shared_task
+def archive_old_events():
+    """
+    Move events older than ARCHIVE_AFTER_DAYS from the OLTP store into
+    compressed Parquet archives, then compact the store and prune ingest
+    log segments every consumer is done with.
+    """
+
+    cutoff = datetime.now(pytz.UTC).replace(tzinfo=None) - timedelta(
+        days=ARCHIVE_AFTER_DAYS
+    )
+
+    db = WriteSessionLocal()
+    try:
+        archived = archive_events(db, cutoff)
     finally:
-        conn.close()
         db.close()
+
+    if archived:
+        compact_store(write_engine)
+    get_ingest_log().prune()
+
+    return f"Archived {archived} events"
@@ -1,10 +1,16 @@
+from datetime import datetime, timezone
+from uuid import uuid4
+
+import duckdb
 import pytest
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from celery import Celery
 
 from app.tasks import create_events_task
+from app.db import duck
 from app.db.engine import Base
+from app.schemas import EventCreate
 
 
 @pytest.fixture
@@ -19,3 +25,164 @@ def db_session():
         yield session
     finally:
         session.close()
+
+
+def make_event(
+    occurred_at=None, user_id=1, event_type="login", event_id=None, properties=None
+):
+    return EventCreate(
+        event_id=event_id or uuid4(),
+        occurred_at=occurred_at or datetime.now(timezone.utc),
+        user_id=user_id,
+        event_type=event_type,
+        properties=properties or {},
+    )
+
+
+@pytest.fixture
+def duck_path(tmp_path, monkeypatch):
+    path = tmp_path / "analytics.duckdb"
+    monkeypatch.setattr(duck, "DUCKDB_PATH", path)
+    monkeypatch.setattr(duck, "SNAPSHOT_DIR", tmp_path / "snapshots")
+    return path
+
+
+@pytest.fixture
+def duck_snapshot(duck_path):
+    """
+    An empty analytics file with a published snapshot.
+    """
+
+    duckdb.connect(str(duck_path)).close()
+    duck.publish_snapshot()
+    return duck_path
+
+
+def sync_to_duck(events, watermark):
+    """
+    Write events to the analytics file as if the loader had synced them up
+    to `watermark`, and publish a snapshot of it.
+    """
+
+    conn = duckdb.connect(str(duck.DUCKDB_PATH))
+    conn.execute(
+        "CREATE TABLE events (event_id UUID, user_id INTEGER, "
+        "occurred_at TIMESTAMP, event_type TEXT, properties JSON)"
+    )
+    conn.execute("CREATE TABLE sync_state (name TEXT PRIMARY KEY, watermark TIMESTAMP)")
+    conn.executemany(
+        "INSERT INTO events VALUES (?, ?, ?, ?, NULL)",
+        [(str(e.event_id), e.user_id, e.occurred_at, e.event_type) for e in events],
+    )
+    conn.execute("INSERT INTO sync_state VALUES ('events', ?)", [watermark])
+    conn.close()
+    duck.publish_snapshot()
+
+
+class FakeRedis:
+    """
+    In-memory stand-in for the Redis commands the app uses. Bitmaps and
+    HyperLogLogs are kept as exact sets; every pipeline execute counts as
+    one round trip.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def setnx(self, key, value):
+        return self.set(key, value, nx=True)
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    def pttl(self, key):
+        if key not in self.data:
+            return -2
+        return self.ttls.get(key, -1)
+
+    def incrby(self, key, n):
+        self.data[key] = int(self.data.get(key, 0)) + n
+        return self.data[key]
+
+    def bitfield(self, key):
+        return FakeBitField(self, key)
+
+    def pfadd(self, key, *values):
+        self.data.setdefault(key, set()).update(values)
+
+    def pfcount(self, key):
+        return len(self.data.get(key, ()))
+
+    def zincrby(self, key, amount, member):
+        zset = self.data.setdefault(key, {})
+        zset[member] = zset.get(member, 0) + amount
+
+    def zrange(self, key, start, end, withscores=False):
+        return sorted(self.data.get(key, {}).items(), key=lambda item: item[1])
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        self.client.round_trips += 1
+        return [getattr(self.client, n)(*a, **kw) for n, a, kw in self.calls]
+
+
+class FakeBitField:
+    """
+    BITFIELD builder supporting GET and SET of u1 fields.
+    """
+
+    def __init__(self, client, key):
+        self.client = client
+        self.key = key
+        self.operations = []
+
+    def get(self, fmt, offset):
+        assert fmt == "u1"
+        self.operations.append(("GET", offset))
+        return self
+
+    def set(self, fmt, offset, value):
+        assert fmt == "u1" and value == 1
+        self.operations.append(("SET", offset))
+        return self
+
+    def execute(self):
+        self.client.round_trips += 1
+        bits = self.client.data.setdefault(self.key, set())
+        result = []
+        for name, offset in self.operations:
+            result.append(int(offset in bits))
+            if name == "SET":
+                bits.add(offset)
+        return result
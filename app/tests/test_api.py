@@ -22,6 +22,20 @@ def test_create_events_idempotent(db_session):
     assert len(created_again) == 0
 
 
+def test_create_events_skips_duplicates_within_batch(db_session):
+    event_data = EventCreate(
+        event_id=uuid4(),
+        occurred_at=datetime.now(),
+        user_id=1,
+        event_type="login",
+        properties={},
+    )
+
+    created = create_events(db_session, [event_data, event_data])
+    db_session.commit()
+    assert len(created) == 1
+
+
 def test_get_dau_and_top_events(db_session):
     now = datetime.now()
     events = [
@@ -0,0 +1,119 @@
+from datetime import datetime
+
+import duckdb
+import pytest
+
+from app.crud import create_events
+from app.db import archive, models
+from app.db.event_filter import EventIdFilter
+from conftest import make_event, sync_to_duck
+
+
+@pytest.fixture
+def archive_dir(duck_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", tmp_path / "archive")
+    monkeypatch.setattr(archive, "ARCHIVE_FILTER_CAPACITY", 1000)
+    monkeypatch.setattr(archive, "_archive_filter", None)
+    monkeypatch.setattr(archive, "_archive_filter_mtime", None)
+    return tmp_path / "archive"
+
+
+def test_archive_moves_old_events_and_keeps_idempotency(
+    db_session, archive_dir, tmp_path
+):
+    old = [make_event(datetime(2025, 1, 1, 10)), make_event(datetime(2025, 1, 2, 10))]
+    recent = [make_event(datetime(2025, 6, 1, 10))]
+    hot_filter = EventIdFilter(capacity=1000, path=tmp_path / "hot.bloom")
+    create_events(db_session, old + recent, hot_filter)
+    sync_to_duck(old + recent, datetime(2025, 6, 1, 10))
+
+    archived = archive.archive_events(db_session, datetime(2025, 3, 1))
+
+    assert archived == 2
+    assert db_session.query(models.Event).count() == 1
+    assert len(list(archive_dir.glob("events_*.parquet"))) == 2
+
+    fresh_filter = EventIdFilter(capacity=1000, path=tmp_path / "fresh.bloom")
+    created = create_events(db_session, old, fresh_filter)
+    assert created == []
+
+
+def test_archive_streams_a_day_in_batches(
+    db_session, archive_dir, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(archive, "ARCHIVE_BATCH_SIZE", 2)
+    events = [make_event(datetime(2025, 1, 1, hour), hour) for hour in range(5)]
+    create_events(
+        db_session, events, EventIdFilter(capacity=1000, path=tmp_path / "hot.bloom")
+    )
+    sync_to_duck(events, datetime(2025, 6, 1))
+
+    assert archive.archive_events(db_session, datetime(2025, 3, 1)) == 5
+    assert db_session.query(models.Event).count() == 0
+
+    (path,) = archive_dir.glob("events_*.parquet")
+    rows = duckdb.sql(f"SELECT event_id, user_id FROM '{path}'").fetchall()
+    assert [r[0] for r in rows] == sorted(e.event_id for e in events)
+    assert sorted(r[1] for r in rows) == list(range(5))
+    assert archive.find_archived_event_ids([e.event_id for e in events]) == {
+        e.event_id for e in events
+    }
+
+
+def test_archive_skips_days_missing_from_analytics(db_session, archive_dir, tmp_path):
+    events = [
+        make_event(datetime(2025, 1, 1, 10)),
+        make_event(datetime(2025, 1, 1, 11)),
+    ]
+    create_events(
+        db_session, events, EventIdFilter(capacity=1000, path=tmp_path / "hot.bloom")
+    )
+    # Same number of events for the day, but one of them is another event.
+    sync_to_duck(
+        events[:1] + [make_event(datetime(2025, 1, 1, 12))], datetime(2025, 6, 1)
+    )
+
+    assert archive.archive_events(db_session, datetime(2025, 3, 1)) == 0
+    assert db_session.query(models.Event).count() == 2
+
+
+def test_archived_ids_are_seen_by_processes_with_a_stale_filter(
+    db_session, archive_dir, tmp_path
+):
+    assert archive.get_archive_filter().count == 0
+
+    # Another worker archives events and saves the filter.
+    old = [make_event(datetime(2025, 1, 1, 10))]
+    create_events(
+        db_session, old, EventIdFilter(capacity=1000, path=tmp_path / "hot.bloom")
+    )
+    sync_to_duck(old, datetime(2025, 6, 1))
+    stale = archive._archive_filter
+    archive._archive_filter = None
+    assert archive.archive_events(db_session, datetime(2025, 3, 1)) == 1
+    archive._archive_filter = stale
+
+    assert archive.find_archived_event_ids([old[0].event_id]) == {old[0].event_id}
+
+    created = create_events(
+        db_session, old, EventIdFilter(capacity=1000, path=tmp_path / "fresh.bloom")
+    )
+    assert created == []
+
+
+def test_missing_archive_filter_is_rebuilt_from_parquet(
+    db_session, archive_dir, tmp_path
+):
+    old = [make_event(datetime(2025, 1, 1, 10)), make_event(datetime(2025, 1, 2, 10))]
+    create_events(
+        db_session, old, EventIdFilter(capacity=1000, path=tmp_path / "hot.bloom")
+    )
+    sync_to_duck(old, datetime(2025, 6, 1))
+    archive.archive_events(db_session, datetime(2025, 3, 1))
+
+    (archive_dir / "event_ids.bloom").unlink()
+    archive._archive_filter = None
+
+    event_ids = [e.event_id for e in old]
+    assert archive.find_archived_event_ids(event_ids) == set(event_ids)
+    assert (archive_dir / "event_ids.bloom").exists()
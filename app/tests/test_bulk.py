@@ -0,0 +1,76 @@
+import json
+import os
+from datetime import datetime, timezone
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from app.db import models
+from app.db.bulk import EVENT_COLUMNS, _copy_row, bulk_insert_events
+from app.db.engine import Base
+
+TEST_POSTGRES_URL = os.getenv("TEST_POSTGRES_URL")
+
+TRICKY_PROPERTIES = {"note": 'tab\there\\ "quoted"\nnew line', "n": None}
+
+
+def make_row(properties=TRICKY_PROPERTIES):
+    return {
+        "event_id": uuid4(),
+        "occurred_at": datetime(2025, 1, 1, 10, 30, 15, 123456, tzinfo=timezone.utc),
+        "user_id": 7,
+        "event_type": "purchase\tfinal",
+        "properties": properties,
+    }
+
+
+def test_copy_row_follows_column_order_and_encodes_properties():
+    row = make_row()
+
+    copied = _copy_row(row)
+
+    assert len(copied) == len(EVENT_COLUMNS)
+    assert copied[:4] == (
+        row["event_id"],
+        row["occurred_at"],
+        row["user_id"],
+        "purchase\tfinal",
+    )
+    assert json.loads(copied[4]) == TRICKY_PROPERTIES
+    assert _copy_row(make_row(properties=None))[4] is None
+
+
+@pytest.fixture
+def pg_session():
+    if not TEST_POSTGRES_URL:
+        pytest.skip("TEST_POSTGRES_URL is not set")
+    engine = create_engine(TEST_POSTGRES_URL)
+    Base.metadata.drop_all(bind=engine, tables=[models.Event.__table__])
+    Base.metadata.create_all(bind=engine, tables=[models.Event.__table__])
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+        Base.metadata.drop_all(bind=engine, tables=[models.Event.__table__])
+        engine.dispose()
+
+
+def test_copy_round_trips_escapes_nulls_and_timestamps(pg_session):
+    rows = [make_row(), make_row(properties=None)]
+
+    bulk_insert_events(pg_session, rows)
+    pg_session.commit()
+
+    stored = {e.event_id: e for e in pg_session.query(models.Event)}
+    first, second = stored[rows[0]["event_id"]], stored[rows[1]["event_id"]]
+    assert first.event_type == "purchase\tfinal"
+    assert first.properties == TRICKY_PROPERTIES
+    assert first.occurred_at.replace(tzinfo=timezone.utc) == rows[0]["occurred_at"]
+    assert second.properties is None
+
+    with pytest.raises(IntegrityError):
+        bulk_insert_events(pg_session, rows[:1])
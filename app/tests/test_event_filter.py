@@ -0,0 +1,101 @@
+from uuid import uuid4
+
+from app.crud import create_events
+from app.db import models
+from app.db.event_filter import EventIdFilter
+from conftest import FakeRedis, make_event
+
+
+def test_filter_has_no_false_negatives(tmp_path):
+    id_filter = EventIdFilter(capacity=1000, path=tmp_path / "ids.bloom")
+    ids = [uuid4() for _ in range(500)]
+
+    id_filter.add_many(ids)
+
+    assert all(id_filter.might_contain_many(ids))
+
+
+def test_filter_rotation_keeps_previous_generation(tmp_path):
+    id_filter = EventIdFilter(capacity=100, path=tmp_path / "ids.bloom")
+    old_ids = [uuid4() for _ in range(100)]
+    new_ids = [uuid4() for _ in range(50)]
+
+    id_filter.add_many(old_ids)
+    id_filter.add_many(new_ids)
+
+    assert all(id_filter.might_contain_many(old_ids + new_ids))
+
+
+def test_filter_save_and_load(tmp_path):
+    path = tmp_path / "ids.bloom"
+    ids = [uuid4() for _ in range(10)]
+    id_filter = EventIdFilter(capacity=1000, path=path)
+    id_filter.add_many(ids)
+    id_filter.save()
+
+    loaded = EventIdFilter(capacity=1000, path=path)
+
+    assert loaded.load()
+    assert all(loaded.might_contain_many(ids))
+
+
+def test_create_events_catches_ids_missing_from_filter(db_session, tmp_path):
+    event = make_event()
+    create_events(
+        db_session, [event], EventIdFilter(capacity=1000, path=tmp_path / "a.bloom")
+    )
+
+    fresh_filter = EventIdFilter(capacity=1000, path=tmp_path / "b.bloom")
+    created = create_events(db_session, [event, make_event()], fresh_filter)
+
+    assert len(created) == 1
+    assert all(fresh_filter.might_contain_many([event.event_id]))
+
+
+def redis_filter(tmp_path, client):
+    id_filter = EventIdFilter(capacity=1000, path=tmp_path / "ids.bloom")
+    id_filter.redis, id_filter.local = client, None
+    return id_filter
+
+
+def test_shared_filter_is_rebuilt_once_and_never_cleared(db_session, tmp_path):
+    stored = make_event()
+    db_session.add(models.Event(**stored.model_dump()))
+    db_session.commit()
+    client = FakeRedis()
+
+    client.set("event_filter:rebuild", "other-process")
+    assert not redis_filter(tmp_path, client).rebuild(db_session)
+    assert redis_filter(tmp_path, client).is_empty
+    client.delete("event_filter:rebuild")
+
+    first = redis_filter(tmp_path, client)
+    assert first.rebuild(db_session)
+    live = uuid4()
+    first.add_many([live])
+
+    assert not redis_filter(tmp_path, client).rebuild(db_session)
+    assert all(first.might_contain_many([stored.event_id, live]))
+    assert client.exists("event_filter:rebuild") == 0
+
+
+def test_shared_filter_sends_one_bitfield_per_generation(tmp_path):
+    client = FakeRedis()
+    id_filter = redis_filter(tmp_path, client)
+    ids = [uuid4() for _ in range(50)]
+
+    id_filter.add_many(ids)
+    assert client.round_trips == 1
+
+    assert all(id_filter.might_contain_many(ids))
+    assert client.round_trips == 3
+
+
+def test_concurrent_saves_use_separate_temp_files(tmp_path):
+    path = tmp_path / "ids.bloom"
+    filters = [EventIdFilter(capacity=1000, path=path) for _ in range(2)]
+    for id_filter in filters:
+        id_filter.add_many([uuid4()])
+        id_filter.save()
+
+    assert [p.name for p in tmp_path.iterdir()] == ["ids.bloom"]
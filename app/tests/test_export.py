@@ -0,0 +1,129 @@
+import asyncio
+import gzip
+import io
+import json
+import threading
+import time
+from datetime import date
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from fastapi import HTTPException
+
+from app import guards
+from app.db import duck
+from app.db.duck import QueryCancelled
+from app.export import stream_events
+
+
+@pytest.fixture
+def events_snapshot(duck_path, monkeypatch):
+    conn = duckdb.connect(str(duck_path))
+    conn.execute(
+        """
+        CREATE TABLE events AS
+        SELECT uuid() AS event_id,
+               (i % 10)::INTEGER AS user_id,
+               TIMESTAMP '2025-01-01' + INTERVAL (i) MINUTE AS occurred_at,
+               CASE WHEN i % 2 = 0 THEN 'login' ELSE 'purchase' END AS event_type,
+               '{"country": "UA"}'::JSON AS properties
+        FROM range(3000) t(i)
+    """
+    )
+    conn.close()
+    duck.publish_snapshot()
+    monkeypatch.setattr("app.export.EXPORT_BATCH_ROWS", 500)
+    return duck_path
+
+
+def test_export_ndjson_streams_in_batches(events_snapshot):
+    chunks = list(
+        stream_events(
+            "ndjson", date(2025, 1, 1), date(2025, 1, 1), {"event_type": "login"}
+        )
+    )
+
+    lines = b"".join(chunks).decode().splitlines()
+    assert len(chunks) > 1
+    assert len(lines) == 720
+    assert json.loads(lines[0])["properties"] == {"country": "UA"}
+    assert len({json.loads(line)["event_id"] for line in lines}) == 720
+
+
+def test_export_csv_gzip(events_snapshot):
+    body = b"".join(stream_events("csv", date(2025, 1, 1), date(2025, 1, 3), gzip=True))
+
+    rows = gzip.decompress(body).decode().splitlines()
+    assert rows[0] == '"event_id","user_id","occurred_at","event_type","properties"'
+    assert len(rows) == 3001
+
+
+def test_export_parquet_and_arrow(events_snapshot):
+    parquet = b"".join(stream_events("parquet", date(2025, 1, 1), date(2025, 1, 3)))
+    arrow = b"".join(stream_events("arrow", date(2025, 1, 1), date(2025, 1, 3)))
+
+    table = pq.read_table(io.BytesIO(parquet))
+    assert table.num_rows == 3000
+    assert table.column_names[0] == "event_id"
+    assert pa.ipc.open_stream(arrow).read_all().num_rows == 3000
+
+
+class FakeRequest:
+    def __init__(self):
+        self.disconnected = False
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+
+@pytest.fixture
+def export_slots(monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(guards, "_export_slots", slots)
+    return slots
+
+
+def test_export_is_rejected_when_all_slots_are_busy(events_snapshot, export_slots):
+    export_slots.acquire()
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(
+            guards.run_export(
+                FakeRequest(), stream_events, "csv", date(2025, 1, 1), date(2025, 1, 3)
+            )
+        )
+    assert exc.value.status_code == 503
+
+
+def test_export_stops_and_frees_its_slot_on_disconnect(events_snapshot, export_slots):
+    request = FakeRequest()
+
+    async def consume():
+        stream = await guards.run_export(
+            request, stream_events, "csv", date(2025, 1, 1), date(2025, 1, 3)
+        )
+        chunks = [await stream.__anext__()]
+        request.disconnected = True
+        async for chunk in stream:
+            chunks.append(chunk)
+        return chunks
+
+    assert len(asyncio.run(consume())) == 1
+    assert export_slots.acquire(blocking=False)
+
+
+def test_export_runs_out_of_time(events_snapshot, export_slots, monkeypatch):
+    monkeypatch.setattr(guards, "EXPORT_TIMEOUT", 0.05)
+
+    async def consume():
+        stream = await guards.run_export(
+            FakeRequest(), stream_events, "csv", date(2025, 1, 1), date(2025, 1, 3)
+        )
+        time.sleep(0.1)
+        return [chunk async for chunk in stream]
+
+    with pytest.raises(QueryCancelled, match="time budget"):
+        asyncio.run(consume())
+    assert export_slots.acquire(blocking=False)
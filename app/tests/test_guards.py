@@ -0,0 +1,162 @@
+import asyncio
+import threading
+from datetime import date
+from zoneinfo import ZoneInfo
+
+import duckdb
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import text
+
+from app import guards
+from app.db import duck
+from app.db.duck import QueryCancelled, QueryScope, current_scope, query_analytics
+from app.guards import check_date_range, check_timezone, run_analytics
+from app.timezones import local_day_bounds
+
+SLOW_QUERY = "SELECT COUNT(*) FROM range(10000000000)"
+SLOW_OLTP_QUERY = (
+    "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) "
+    "SELECT COUNT(*) FROM (SELECT x FROM c LIMIT 10000000000)"
+)
+
+
+class FakeRequest:
+    def __init__(self, disconnected=False):
+        self.disconnected = disconnected
+
+    async def is_disconnected(self):
+        return self.disconnected
+
+
+def test_check_date_range_rejects_long_and_inverted_ranges():
+    check_date_range(date(2025, 1, 1), date(2025, 12, 31))
+
+    with pytest.raises(HTTPException):
+        check_date_range(date(2020, 1, 1), date(2025, 1, 1))
+    with pytest.raises(HTTPException):
+        check_date_range(date(2025, 1, 2), date(2025, 1, 1))
+
+
+def test_check_timezone_accepts_whole_hour_zones_only():
+    assert check_timezone(None, date(2025, 1, 1), date(2025, 1, 2)) is None
+    assert check_timezone("UTC", date(2025, 1, 1), date(2025, 1, 2)) is None
+
+    kyiv = check_timezone("Europe/Kyiv", date(2025, 3, 29), date(2025, 3, 31))
+    bounds = local_day_bounds(date(2025, 3, 29), date(2025, 3, 31), kyiv)
+    lengths = [(end - start).total_seconds() / 3600 for start, end in bounds.values()]
+    assert lengths == [24, 23, 24]
+
+    with pytest.raises(HTTPException):
+        check_timezone("Mars/Olympus", date(2025, 1, 1), date(2025, 1, 2))
+    with pytest.raises(HTTPException):
+        check_timezone("Asia/Kolkata", date(2025, 1, 1), date(2025, 1, 2))
+
+
+@pytest.mark.parametrize("name", ["Europe", "x" * 300, "Europe/" + "x" * 5000])
+def test_check_timezone_rejects_directories_and_garbage(name):
+    with pytest.raises(HTTPException) as e:
+        check_timezone(name, date(2025, 1, 1), date(2025, 1, 2))
+    assert e.value.status_code == 422
+    assert local_day_bounds(date(2025, 1, 1), date(2025, 1, 1), ZoneInfo("UTC"))
+
+
+def test_query_analytics_times_out(duck_snapshot, monkeypatch):
+    monkeypatch.setattr(duck, "DUCKDB_QUERY_TIMEOUT", 0.1)
+
+    with pytest.raises(QueryCancelled, match="time budget"):
+        query_analytics(SLOW_QUERY)
+
+
+def test_cancelled_scope_interrupts_running_query(duck_snapshot):
+    scope = QueryScope()
+    token = current_scope.set(scope)
+    threading.Timer(0.1, scope.cancel).start()
+
+    try:
+        with pytest.raises(QueryCancelled, match="cancelled"):
+            query_analytics(SLOW_QUERY)
+    finally:
+        current_scope.reset(token)
+
+
+def test_snapshot_held_by_reader_is_not_retired(duck_snapshot):
+    snapshot = duck.Snapshot()
+    held = {p.name for p in duck.SNAPSHOT_DIR.glob("analytics-*.duckdb")}
+
+    duck.publish_snapshot()
+    duck.publish_snapshot()
+    remaining = {p.name for p in duck.SNAPSHOT_DIR.glob("analytics-*.duckdb")}
+    assert held <= remaining
+    assert len(remaining) == 2
+
+    assert snapshot.conn.execute("SELECT 1").fetchone() == (1,)
+    snapshot.close()
+    duck.publish_snapshot()
+    assert not held & {p.name for p in duck.SNAPSHOT_DIR.glob("analytics-*.duckdb")}
+
+
+def test_dangling_snapshot_pointer_raises_instead_of_spinning(duck_snapshot):
+    (duck.SNAPSHOT_DIR / "CURRENT").write_text("analytics-missing.duckdb")
+
+    with pytest.raises(duckdb.IOException, match="missing"):
+        duck.Snapshot()
+
+
+def test_concurrent_publishers_keep_current_valid(duck_snapshot):
+    def publish():
+        for _ in range(5):
+            duck.publish_snapshot()
+
+    threads = [threading.Thread(target=publish) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    current = (duck.SNAPSHOT_DIR / "CURRENT").read_text()
+    assert (duck.SNAPSHOT_DIR / current).exists()
+    with duck.Snapshot() as conn:
+        assert conn.execute("SELECT 1").fetchone() == (1,)
+
+
+def test_oltp_query_in_scope_times_out(db_session, monkeypatch):
+    monkeypatch.setattr(guards, "ANALYTICS_OLTP_TIMEOUT", 0.1)
+    token = current_scope.set(QueryScope())
+
+    try:
+        with pytest.raises(QueryCancelled, match="time budget"):
+            db_session.execute(text(SLOW_OLTP_QUERY))
+    finally:
+        current_scope.reset(token)
+
+    db_session.rollback()
+    assert db_session.execute(text("SELECT 1")).scalar() == 1
+
+
+def test_run_analytics_rejects_when_all_slots_are_busy(monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(guards, "_slots", slots)
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(run_analytics(FakeRequest(), lambda: 1))
+
+    assert exc.value.status_code == 503
+    assert exc.value.headers == {"Retry-After": "1"}
+
+
+def test_disconnect_cancels_running_oltp_query(db_session, monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(guards, "_slots", slots)
+
+    def slow():
+        return db_session.execute(text(SLOW_OLTP_QUERY)).scalar()
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(run_analytics(FakeRequest(disconnected=True), slow))
+
+    assert exc.value.status_code == 499
+    # The interrupted query has finished, and given its slot back, before
+    # the 499 is raised and the request's session is closed.
+    assert slots.acquire(blocking=False)
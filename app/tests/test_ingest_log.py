@@ -0,0 +1,146 @@
+import os
+from datetime import datetime
+from uuid import uuid4
+
+import orjson
+import pytest
+
+from app import ingest_log as ingest_log_module
+from app import tasks
+from app.db import duck
+from app.ingest_log import IngestLog
+from cli import replay_log
+
+
+@pytest.fixture
+def ingest_log(tmp_path, monkeypatch):
+    log = IngestLog(tmp_path / "log")
+    monkeypatch.setattr(ingest_log_module, "_ingest_log", log)
+    return log
+
+
+def make_event(user_id=1, event_id=None):
+    return {
+        "event_id": str(event_id or uuid4()),
+        "occurred_at": datetime(2025, 1, 1, 10).isoformat(),
+        "user_id": user_id,
+        "event_type": "login",
+        "properties": {},
+    }
+
+
+def test_log_reads_across_segments(ingest_log, monkeypatch):
+    monkeypatch.setattr(ingest_log_module, "INGEST_LOG_SEGMENT_BYTES", 200)
+
+    records = [ingest_log.append([make_event(i)]) for i in range(5)]
+
+    assert len(list(ingest_log.path.glob("*.log"))) > 1
+    read = [r for chunk in ingest_log.scan(0) for r in chunk]
+    assert [r.offset for r in read] == [r.offset for r in records]
+    assert [r.events[0]["user_id"] for r in read] == list(range(5))
+    assert ingest_log.read_at(records[3].offset).events[0]["user_id"] == 3
+
+
+def test_ack_commits_contiguous_prefix_only(ingest_log):
+    first, second, third = (ingest_log.append([make_event()]) for _ in range(3))
+
+    ingest_log.ack("oltp", second.offset, second.next_offset)
+    assert ingest_log.committed("oltp") == 0
+    assert [r.offset for r in ingest_log.unacked("oltp", before=float("inf"))] == [
+        first.offset,
+        third.offset,
+    ]
+
+    ingest_log.ack("oltp", first.offset, first.next_offset)
+    assert ingest_log.committed("oltp") == second.next_offset
+
+
+def test_redelivery_skips_and_dead_letters_a_failing_record(ingest_log, monkeypatch):
+    monkeypatch.setattr(ingest_log_module, "INGEST_LOG_MAX_REDELIVERIES", 2)
+    monkeypatch.setattr(tasks, "INGEST_LOG_REDELIVER_AFTER", -1)
+    monkeypatch.setattr(tasks, "_queued_tasks", lambda: 0)
+    applied = []
+
+    def apply_events(events, redelivered=False):
+        if events[0]["user_id"] == 2:
+            raise ValueError("bad record")
+        applied.append(events[0]["user_id"])
+
+    monkeypatch.setattr(tasks, "apply_events", apply_events)
+    records = [ingest_log.append([make_event(i)]) for i in range(1, 4)]
+
+    assert tasks.redeliver_ingest_log() == "Redelivered 2 records, 1 failed"
+    assert applied == [1, 3]
+    assert ingest_log.committed("oltp") == records[1].offset
+    assert not ingest_log.dead_letter_path("oltp").exists()
+
+    assert tasks.redeliver_ingest_log() == "Redelivered 0 records, 1 failed"
+    assert ingest_log.committed("oltp") == ingest_log.end_offset()
+    dead = orjson.loads(ingest_log.dead_letter_path("oltp").read_bytes())
+    assert dead["offset"] == records[1].offset
+    assert "bad record" in dead["error"]
+
+    assert tasks.redeliver_ingest_log() == "Redelivered 0 records, 0 failed"
+
+
+def test_redelivery_waits_for_queued_tasks(ingest_log, monkeypatch):
+    monkeypatch.setattr(tasks, "INGEST_LOG_REDELIVER_AFTER", -1)
+    monkeypatch.setattr(tasks, "_queued_tasks", lambda: 5)
+    monkeypatch.setattr(tasks, "apply_events", pytest.fail)
+    ingest_log.append([make_event()])
+
+    assert tasks.redeliver_ingest_log() == "5 tasks still queued, not redelivering"
+    assert ingest_log.committed("oltp") == 0
+
+
+def test_replay_refuses_pruned_offsets(ingest_log, monkeypatch):
+    monkeypatch.setattr(ingest_log_module, "INGEST_LOG_SEGMENT_BYTES", 200)
+    records = [ingest_log.append([make_event(i)]) for i in range(5)]
+    for consumer in ("oltp", "analytics"):
+        ingest_log.commit(consumer, ingest_log.end_offset())
+    for segment in ingest_log._segments():
+        os.utime(segment, (0, 0))
+
+    assert ingest_log.prune() > 0
+    assert ingest_log.start_offset() > records[0].offset
+
+    with pytest.raises(SystemExit):
+        replay_log.replay_analytics(0)
+    with pytest.raises(SystemExit):
+        replay_log.replay_oltp(0)
+
+
+def test_sync_loads_log_once_and_skips_duplicate_ids(ingest_log, duck_path):
+    duplicate = uuid4()
+    ingest_log.append([make_event(1, duplicate), make_event(2)])
+    ingest_log.append([make_event(1, duplicate)])
+
+    assert tasks.sync_events_to_duck() == "Synced 2 events"
+    assert tasks.sync_events_to_duck() == "No new events"
+
+    ingest_log.append([make_event(3)])
+    assert tasks.sync_events_to_duck() == "Synced 1 events"
+    assert ingest_log.committed("analytics") == ingest_log.end_offset()
+    assert tasks.publish_analytics_snapshots() == "Published 1 snapshots"
+    assert duck.query_analytics("SELECT COUNT(*) FROM events") == [(3,)]
+
+
+def test_snapshots_are_published_only_when_the_shard_changed(ingest_log, duck_path):
+    assert tasks.publish_analytics_snapshots() == "Published 0 snapshots"
+
+    ingest_log.append([make_event(1)])
+    tasks.sync_events_to_duck()
+    assert tasks.publish_analytics_snapshots() == "Published 1 snapshots"
+
+    tasks.sync_events_to_duck()
+    assert tasks.publish_analytics_snapshots() == "Published 0 snapshots"
+
+    ingest_log.append([make_event(2)])
+    tasks.sync_events_to_duck()
+    writer = duck.get_duck_conn()
+    try:
+        assert tasks.publish_analytics_snapshots() == "Published 0 snapshots"
+    finally:
+        writer.close()
+    assert tasks.publish_analytics_snapshots() == "Published 1 snapshots"
+    assert duck.query_analytics("SELECT COUNT(*) FROM events") == [(2,)]
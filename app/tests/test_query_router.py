@@ -0,0 +1,220 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import duckdb
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from app import ingest_log, profiling, query_router, tasks
+from app.crud import create_events
+from app.db import duck
+from app.ingest_log import IngestLog
+from cli import reshard
+from conftest import make_event, sync_to_duck
+
+
+def test_router_merges_duck_history_with_oltp_tail(db_session, duck_path):
+    synced = [
+        make_event(datetime(2025, 1, 1, 10), 1),
+        make_event(datetime(2025, 1, 2, 9), 1),
+        make_event(datetime(2025, 1, 2, 10), 2, "purchase"),
+    ]
+    tail = [
+        make_event(datetime(2025, 1, 2, 11), 2),
+        make_event(datetime(2025, 1, 2, 12), 3),
+        make_event(datetime(2025, 1, 3, 8), 1),
+    ]
+    create_events(db_session, synced + tail)
+    sync_to_duck(synced, datetime(2025, 1, 2, 10))
+
+    dau = query_router.get_dau(
+        db_session, datetime(2025, 1, 1).date(), datetime(2025, 1, 3).date()
+    )
+    assert dau.columns["count"] == [1, 3, 1]
+
+    top = query_router.get_top_events(
+        db_session, datetime(2025, 1, 1).date(), datetime(2025, 1, 3).date()
+    )
+    assert top.rows()[0] == ("login", 5)
+
+    retention = query_router.get_retention(db_session, datetime(2025, 1, 2).date(), 3)
+    assert retention.columns["active_users"] == [3, 1, 0]
+
+
+def test_router_uses_oltp_when_nothing_synced(db_session, duck_path):
+    duckdb.connect(str(duck_path)).close()
+    duck.publish_snapshot()
+    create_events(db_session, [make_event(datetime(2025, 1, 1, 10), 1)])
+
+    dau = query_router.get_dau(
+        db_session, datetime(2025, 1, 1).date(), datetime(2025, 1, 1).date()
+    )
+
+    assert dau.columns["count"] == [1]
+
+
+def test_sharded_store_sums_users_across_shards(
+    db_session, duck_path, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(duck, "ANALYTICS_SHARDS", 3)
+    monkeypatch.setattr(tasks, "ANALYTICS_SHARDS", 3)
+    log = IngestLog(tmp_path / "log")
+    monkeypatch.setattr(ingest_log, "_ingest_log", log)
+
+    events = [
+        make_event(datetime(2025, 1, 1, hour), user_id)
+        for user_id in range(12)
+        for hour in (9, 10)
+    ] + [
+        make_event(datetime(2025, 1, 2, 9), user_id, "purchase") for user_id in range(5)
+    ]
+    log.append([e.model_dump() for e in events])
+
+    assert tasks.sync_events_to_duck() == "Synced 29 events"
+    assert tasks.publish_analytics_snapshots() == "Published 3 snapshots"
+    assert len(list(tmp_path.glob("analytics_*.duckdb"))) == 3
+
+    from_, to = datetime(2025, 1, 1).date(), datetime(2025, 1, 2).date()
+    assert query_router.get_dau(db_session, from_, to).columns["count"] == [12, 5]
+    assert query_router.get_top_events(db_session, from_, to).columns == {
+        "event_type": ["login", "purchase"],
+        "count": [24, 5],
+    }
+
+
+def test_shard_expr_matches_shard_for():
+    user_ids = [-5, 0, 1, 7, 12345, 2**31 - 1]
+    for shards in (1, 2, 3, 8):
+        rows = duckdb.sql(
+            f"SELECT {reshard.shard_expr('u', shards)} "
+            f"FROM unnest({user_ids}) AS t(u)"
+        ).fetchall()
+        expected = [(int(u) * 2654435761) % 2**32 % shards for u in user_ids]
+        assert [r[0] for r in rows] == expected
+
+
+def test_resharding_is_refused_until_history_is_redistributed(
+    db_session, duck_path, tmp_path, monkeypatch
+):
+    log = IngestLog(tmp_path / "log")
+    monkeypatch.setattr(ingest_log, "_ingest_log", log)
+    monkeypatch.setattr(reshard, "DUCKDB_PATH", duck_path)
+    monkeypatch.setattr(reshard, "SNAPSHOT_DIR", duck.SNAPSHOT_DIR)
+    events = [
+        make_event(datetime(2025, 1, 1, hour), user_id)
+        for user_id in range(12)
+        for hour in (9, 10)
+    ]
+    log.append([e.model_dump() for e in events])
+    tasks.sync_events_to_duck()
+    tasks.publish_analytics_snapshots()
+    day = datetime(2025, 1, 1).date()
+
+    for shards in (3, 2):
+        for module in (duck, tasks, reshard):
+            monkeypatch.setattr(module, "ANALYTICS_SHARDS", shards)
+
+        with pytest.raises(duck.ShardCountMismatch):
+            tasks.sync_events_to_duck()
+        with pytest.raises(duck.ShardCountMismatch):
+            query_router.serve_dau(db_session, day, day)
+
+        reshard.reshard()
+
+        assert query_router.serve_dau(db_session, day, day).columns["count"] == [12]
+        for shard in range(shards):
+            users = duck.query_analytics(
+                "SELECT DISTINCT user_id FROM events", shard=shard
+            )
+            assert users and all(duck.shard_for(u) == shard for (u,) in users)
+        assert duck.query_shards("SELECT SUM(events) FROM events_hourly") != []
+        assert tasks.sync_events_to_duck() == "No new events"
+
+
+def test_local_days_come_from_hourly_rollups_and_tail(
+    db_session, duck_path, tmp_path, monkeypatch
+):
+    log = IngestLog(tmp_path / "log")
+    monkeypatch.setattr(ingest_log, "_ingest_log", log)
+
+    # Europe/Kyiv is UTC+2 in January: 22:00 UTC already starts the next day.
+    synced = [
+        make_event(datetime(2025, 1, 1, 21, 30), 1),
+        make_event(datetime(2025, 1, 1, 22, 30), 2),
+        make_event(datetime(2025, 1, 2, 10, 15), 3, "purchase"),
+    ]
+    tail = [
+        make_event(datetime(2025, 1, 2, 12), 4),
+        make_event(datetime(2025, 1, 2, 23), 1),
+    ]
+    create_events(db_session, synced + tail)
+    log.append([e.model_dump() for e in synced])
+    tasks.sync_events_to_duck()
+    log.append([e.model_dump() for e in synced])
+    tasks.sync_events_to_duck()
+    tasks.publish_analytics_snapshots()
+
+    from_, to = datetime(2025, 1, 1).date(), datetime(2025, 1, 3).date()
+    kyiv = ZoneInfo("Europe/Kyiv")
+    assert query_router.get_dau(db_session, from_, to).columns["count"] == [2, 3]
+    assert query_router.get_dau(db_session, from_, to, tz=kyiv).columns == {
+        "day": [from_, datetime(2025, 1, 2).date(), to],
+        "count": [1, 3, 1],
+    }
+
+    day = datetime(2025, 1, 2).date()
+    top = query_router.get_top_events(db_session, day, day, tz=kyiv)
+    assert top.columns == {"event_type": ["login", "purchase"], "count": [2, 1]}
+
+
+def test_failed_profiled_query_does_not_leak_into_the_next(db_session):
+    conn = db_session.connection()
+
+    with profiling.profile_request("/stats/dau") as failed:
+        with pytest.raises(OperationalError):
+            conn.execute(text("SELECT * FROM no_such_table"))
+    assert not conn.info.get("profile_started")
+    assert "no_such_table" in failed.queries[0]["error"]
+
+    with profiling.profile_request("/stats/dau") as profile:
+        conn.execute(text("SELECT 1"))
+    assert len(profile.queries) == 1
+    assert "error" not in profile.queries[0]
+
+
+def test_queries_keep_sql_only_when_profiled_or_slow(db_session, monkeypatch):
+    monkeypatch.setattr(profiling, "SLOW_QUERY_MS", 60_000)
+    conn = db_session.connection()
+
+    with profiling.profile_request("/stats/dau") as profile:
+        conn.execute(text("SELECT :x"), {"x": 1})
+    assert profile.queries[0].keys() == {"store", "ms"}
+
+    with profiling.profile_request("/stats/dau", explain=True) as profile:
+        conn.execute(text("SELECT :x"), {"x": 1})
+    assert profile.to_dict()["queries"][0]["params"] == [1]
+
+
+def test_profile_records_paths_queries_and_plans(
+    db_session, duck_path, monkeypatch, caplog
+):
+    monkeypatch.setattr(profiling, "SLOW_QUERY_MS", 0)
+    synced = [make_event(datetime(2025, 1, 1, 10), 1)]
+    create_events(db_session, synced + [make_event(datetime(2025, 1, 2, 10), 2)])
+    sync_to_duck(synced, datetime(2025, 1, 1, 10))
+
+    with profiling.profile_request("/stats/dau", explain=True) as profile:
+        query_router.serve_dau(
+            db_session, datetime(2025, 1, 1).date(), datetime(2025, 1, 2).date()
+        )
+
+    report = profile.to_dict()
+    assert report["served_by"] == ["duckdb", "oltp_tail"]
+    assert {"duckdb_open", "duckdb_query", "oltp_tail"} <= set(report["phases_ms"])
+
+    duck_queries = [q for q in report["queries"] if q["store"] == "duckdb"]
+    assert duck_queries and all("plan" in q for q in duck_queries)
+    assert any(q["rows_scanned"] == 1 for q in duck_queries)
+    assert any(q["store"] == "oltp" for q in report["queries"])
+    assert "slow_query" in caplog.text
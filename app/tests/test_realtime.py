@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock
+
+import pytest
+
+from app import query_router, realtime, tasks
+from conftest import FakePipeline, FakeRedis, make_event
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    client = FakeRedis()
+    monkeypatch.setattr(realtime, "_client", client)
+    return client
+
+
+def test_counters_are_only_served_once_the_day_was_prepared(redis_client):
+    today = realtime.today()
+    realtime.record_events([make_event(user_id=1)])
+    assert realtime.get_dau(today) is None
+
+    realtime.prepare_day(today)
+    assert realtime.get_dau(today) == 1
+
+
+def test_failed_update_stops_serving_the_day(redis_client, monkeypatch):
+    monkeypatch.setattr(realtime, "_invalid_days", set())
+    today = realtime.today()
+    realtime.prepare_day(today)
+    realtime.record_events([make_event(user_id=1)])
+    assert realtime.get_dau(today) == 1
+
+    class BrokenPipeline(FakePipeline):
+        def execute(self):
+            raise ConnectionError("Redis went away")
+
+    redis_client.pipeline = lambda transaction=True: BrokenPipeline(redis_client)
+    assert not realtime.record_events([make_event(user_id=2)])
+    del redis_client.pipeline
+
+    assert f"rt:complete:{today}" not in redis_client.data
+    assert today in realtime._invalid_days
+    realtime.prepare_day(today)
+    assert realtime.get_dau(today) is None
+
+
+def test_redelivered_duplicates_invalidate_the_day(redis_client, monkeypatch):
+    monkeypatch.setattr(realtime, "_invalid_days", set())
+    today = realtime.today()
+    realtime.prepare_day(today)
+    ev = make_event(user_id=1)
+    monkeypatch.setattr(tasks.crud, "create_events", lambda db, events: [])
+    monkeypatch.setattr(tasks, "WriteSessionLocal", MagicMock)
+
+    tasks.apply_events([ev.model_dump(mode="json")])
+    assert realtime.get_dau(today) == 0
+
+    tasks.apply_events([ev.model_dump(mode="json")], redelivered=True)
+    assert realtime.get_dau(today) is None
+
+
+def test_router_serves_today_from_live_counters(db_session, redis_client):
+    today = realtime.today()
+    realtime.prepare_day(today)
+    realtime.record_events(
+        [
+            make_event(user_id=1),
+            make_event(user_id=1, event_type="purchase"),
+            make_event(user_id=2),
+            make_event(
+                user_id=3, occurred_at=datetime.now(timezone.utc) - timedelta(days=1)
+            ),
+        ]
+    )
+
+    dau = query_router.get_dau(db_session, today, today)
+    assert dau.columns == {"day": [today], "count": [2]}
+
+    top = query_router.get_top_events(db_session, today, today)
+    assert top.columns == {"event_type": ["login", "purchase"], "count": [2, 1]}
@@ -0,0 +1,68 @@
+from datetime import date
+
+import orjson
+import pyarrow as pa
+from starlette.requests import Request
+
+from app.profiling import QueryProfile
+from app.responses import (
+    ARROW_MEDIA_TYPE,
+    COLUMNAR_JSON_MEDIA_TYPE,
+    ROWS_JSON_MEDIA_TYPE,
+    StatsResult,
+    render_stats,
+)
+
+RESULT = StatsResult({"day": [date(2025, 1, 1), date(2025, 1, 2)], "count": [3, 5]})
+
+
+def make_request(accept: str) -> Request:
+    return Request(
+        {"type": "http", "headers": [(b"accept", accept.encode())], "method": "GET"}
+    )
+
+
+def test_render_stats_defaults_to_json_records():
+    response = render_stats(make_request("*/*"), RESULT)
+
+    assert response.media_type == "application/json"
+    assert orjson.loads(response.body) == [
+        {"day": "2025-01-01", "count": 3},
+        {"day": "2025-01-02", "count": 5},
+    ]
+
+
+def test_render_stats_rows_json():
+    response = render_stats(make_request(ROWS_JSON_MEDIA_TYPE), RESULT)
+
+    assert response.media_type == ROWS_JSON_MEDIA_TYPE
+    assert orjson.loads(response.body) == {
+        "columns": ["day", "count"],
+        "rows": [["2025-01-01", 3], ["2025-01-02", 5]],
+    }
+
+
+def test_render_stats_wraps_records_with_profile():
+    profile = QueryProfile("/stats/dau")
+    response = render_stats(make_request(ARROW_MEDIA_TYPE), RESULT, profile)
+
+    body = orjson.loads(response.body)
+    assert body["data"][0] == {"day": "2025-01-01", "count": 3}
+    assert body["profile"]["endpoint"] == "/stats/dau"
+
+
+def test_render_stats_columnar_json():
+    response = render_stats(make_request(COLUMNAR_JSON_MEDIA_TYPE), RESULT)
+
+    assert orjson.loads(response.body) == {
+        "day": ["2025-01-01", "2025-01-02"],
+        "count": [3, 5],
+    }
+
+
+def test_render_stats_arrow():
+    response = render_stats(make_request(ARROW_MEDIA_TYPE), RESULT)
+
+    table = pa.ipc.open_stream(response.body).read_all()
+    assert table.column("count").to_pylist() == [3, 5]
+    assert table.schema.field("day").type == pa.date32()
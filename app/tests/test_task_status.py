@@ -0,0 +1,67 @@
+from datetime import datetime
+from uuid import uuid4
+
+import pytest
+from celery import Celery, states
+
+from app import task_status, tasks
+from conftest import FakeRedis
+
+
+@pytest.fixture
+def celery_app(monkeypatch):
+    app = Celery("test", backend="redis://localhost:6379")
+    client = FakeRedis()
+    monkeypatch.setattr(app.backend, "client", client)
+    return app
+
+
+def store(app, task_id, status, result=None, pttl=None):
+    key = app.backend.get_key_for_task(task_id)
+    meta = {"status": status, "result": result, "traceback": None, "task_id": task_id}
+    app.backend.client.data[key] = app.backend.encode(meta)
+    if pttl is not None:
+        app.backend.client.ttls[key] = pttl
+
+
+def test_statuses_are_read_in_one_round_trip(celery_app, monkeypatch):
+    monkeypatch.setattr(task_status, "MGET_CHUNK_SIZE", 2)
+    receipt = {"created": 2, "duplicates": 1, "rejected": 0, "ttl": 3600}
+    store(celery_app, "done", states.SUCCESS, receipt, pttl=1_500_500)
+    store(celery_app, "running", states.STARTED)
+    store(celery_app, "failed", states.FAILURE, {"exc_type": "ValueError"})
+
+    statuses = task_status.get_task_statuses(
+        celery_app, ["done", "unknown", "running", "failed", "done"]
+    )
+
+    assert celery_app.backend.client.round_trips == 1
+    assert [s["status"] for s in statuses] == [
+        states.SUCCESS,
+        states.PENDING,
+        states.STARTED,
+        states.FAILURE,
+        states.SUCCESS,
+    ]
+    assert statuses[0]["receipt"] == {**receipt, "ttl": 1500}
+    assert "receipt" not in statuses[3]
+
+
+def test_apply_events_returns_counts_receipt(db_session, monkeypatch):
+    monkeypatch.setattr(tasks, "WriteSessionLocal", lambda: db_session)
+    event = {
+        "event_id": str(uuid4()),
+        "occurred_at": datetime(2025, 1, 1, 10).isoformat(),
+        "user_id": 1,
+        "event_type": "login",
+        "properties": {},
+    }
+
+    receipt = tasks.apply_events([event, event, {"user_id": "nope"}])
+
+    assert receipt == {
+        "created": 1,
+        "duplicates": 1,
+        "rejected": 1,
+        "ttl": tasks.RESULT_TTL_SECONDS,
+    }
@@ -0,0 +1,52 @@
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Tuple
+from zoneinfo import ZoneInfo
+
+HOUR = timedelta(hours=1)
+
+
+def local_day_bounds(
+    from_: date, to: date, tz: ZoneInfo
+) -> Dict[date, Tuple[datetime, datetime]]:
+    """
+    Map each local day in [from_, to] to its [start, end) in naive UTC.
+
+    Days are assembled from whole UTC hours, so every local midnight in
+    the range must fall on one; raises ValueError for zones such as
+    Asia/Kolkata (+05:30). DST days come out as 23 or 25 hours long.
+    """
+
+    bounds = {}
+    day = from_
+    start = _utc_midnight(day, tz)
+    while day <= to:
+        end = _utc_midnight(day + timedelta(days=1), tz)
+        bounds[day] = (start, end)
+        day, start = day + timedelta(days=1), end
+    return bounds
+
+
+def _utc_midnight(day: date, tz: ZoneInfo) -> datetime:
+    midnight = datetime.combine(day, datetime.min.time(), tzinfo=tz)
+    utc = midnight.astimezone(timezone.utc).replace(tzinfo=None)
+    if utc.minute or utc.second:
+        raise ValueError(f"{tz.key} is not a whole number of hours from UTC on {day}")
+    return utc
+
+
+def hour_day_map(
+    bounds: Dict[date, Tuple[datetime, datetime]],
+) -> Tuple[List[datetime], List[date]]:
+    """
+    Expand day bounds into parallel lists of UTC hours and the local day
+    each hour belongs to, for joining against hourly rollups.
+    """
+
+    hours, days = [], []
+    for day, (start, end) in bounds.items():
+        hour = start
+        while hour < end:
+            hours.append(hour)
+            days.append(day)
+            hour += HOUR
+    return hours, days
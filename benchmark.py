@@ -3,7 +3,7 @@ from datetime import datetime, timedelta, timezone
 from uuid import uuid4
 
 from app.crud import create_events, get_dau
-from app.db.engine import SessionLocal, Base, engine
+from app.db.engine import WriteSessionLocal, Base, engine
 from app.schemas import EventCreate
 
 
@@ -13,7 +13,7 @@ def run_benchmark(num_events: int = 100_000, num_users: int = 1000, days: int =
     )
 
     Base.metadata.create_all(bind=engine)
-    session = SessionLocal()
+    session = WriteSessionLocal()
 
     now = datetime.now(timezone.utc)
     events = []
@@ -5,25 +5,50 @@ import sys
 
 from datetime import datetime
 from sqlalchemy.orm import Session
-from app.db.engine import SessionLocal
-from app.db.models import Event
+from app import crud, realtime, schemas
+from app.db.engine import WriteSessionLocal
+from app.db.event_filter import warm_event_id_filter
+from app.ingest_log import get_ingest_log
+
+
+IMPORT_BATCH_SIZE = 5000
+
+
+def import_batch(db: Session, batch: list, id_filter) -> list:
+    if not batch:
+        return []
+
+    ingest_log = get_ingest_log()
+    record = ingest_log.append([e.model_dump() for e in batch])
+    created = crud.create_events(db, batch, id_filter)
+    realtime.record_events(created)
+    ingest_log.ack("oltp", record.offset, record.next_offset)
+    return created
 
 
 def import_events(csv_path: str):
     """
     Import historical events from a CSV file into the database.
 
+    Rows are written in batches through crud.create_events, so duplicate
+    checks go through the event_id filter instead of one lookup per row.
+    Each batch is appended to the ingest log first, so the analytics
+    loader picks the imported events up like any other.
+
     Args:
         csv_path (str): Path to the CSV file with columns:
                         event_id, occurred_at, user_id, event_type, properties_json
     """
 
-    db: Session = SessionLocal()
+    db: Session = WriteSessionLocal()
     added, skipped = 0, 0
 
     try:
+        id_filter = warm_event_id_filter(db)
+
         with open(csv_path, newline="", encoding="utf-8") as csvfile:
             reader = csv.DictReader(csvfile)
+            batch = []
 
             for row in reader:
                 try:
@@ -33,26 +58,30 @@ def import_events(csv_path: str):
                     skipped += 1
                     continue
 
-                if db.query(Event).filter_by(event_id=event_id).first():
-                    skipped += 1
-                    continue
-
-                event = Event(
-                    event_id=event_id,
-                    occurred_at=datetime.fromisoformat(row["occurred_at"]),
-                    user_id=row["user_id"],
-                    event_type=row["event_type"],
-                    properties=(
-                        json.loads(row["properties_json"])
-                        if row["properties_json"]
-                        else {}
-                    ),
+                batch.append(
+                    schemas.EventCreate(
+                        event_id=event_id,
+                        occurred_at=datetime.fromisoformat(row["occurred_at"]),
+                        user_id=row["user_id"],
+                        event_type=row["event_type"],
+                        properties=(
+                            json.loads(row["properties_json"])
+                            if row["properties_json"]
+                            else {}
+                        ),
+                    )
                 )
 
-                db.add(event)
-                added += 1
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    created = import_batch(db, batch, id_filter)
+                    added += len(created)
+                    skipped += len(batch) - len(created)
+                    batch = []
 
-            db.commit()
+            created = import_batch(db, batch, id_filter)
+            added += len(created)
+            skipped += len(batch) - len(created)
+            id_filter.save()
 
         print(f"✅ Imported {added} events, skipped {skipped} duplicates.")
 
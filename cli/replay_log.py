@@ -0,0 +1,92 @@
+import sys
+
+import duckdb
+
+from app import crud, realtime, schemas
+from app.db.duck import ANALYTICS_SHARDS, get_duck_conn
+from app.db.engine import WriteSessionLocal
+from app.db.event_filter import warm_event_id_filter
+from app.ingest_log import INGEST_LOG_RETENTION_DAYS, get_ingest_log
+from app.tasks import publish_analytics_snapshots, sync_events_to_duck
+
+
+def check_retained(from_offset: int):
+    """
+    Refuse to replay from an offset whose segment was pruned: the replay
+    would quietly start at the oldest retained record instead.
+    """
+
+    start = get_ingest_log().start_offset()
+    if from_offset < start:
+        print(
+            f"❌ Offset {from_offset} was pruned, the log starts at {start} "
+            f"(INGEST_LOG_RETENTION_DAYS={INGEST_LOG_RETENTION_DAYS}). "
+            "Replaying would skip everything before it."
+        )
+        sys.exit(1)
+
+
+def replay_oltp(from_offset: int):
+    """
+    Re-apply ingest log records from `from_offset` to the OLTP store.
+    Events that are already stored are skipped as duplicates.
+    """
+
+    check_retained(from_offset)
+    ingest_log = get_ingest_log()
+    db = WriteSessionLocal()
+    added, offset = 0, from_offset
+
+    try:
+        id_filter = warm_event_id_filter(db)
+        for records in ingest_log.scan(from_offset):
+            events = [
+                schemas.EventCreate(**e) for record in records for e in record.events
+            ]
+            created = crud.create_events(db, events, id_filter)
+            realtime.record_events(created)
+            added += len(created)
+            offset = records[-1].next_offset
+            ingest_log.commit("oltp", offset)
+        id_filter.save()
+    finally:
+        db.close()
+
+    print(f"✅ Replayed OLTP store up to offset {offset}, added {added} events.")
+
+
+def replay_analytics(from_offset: int):
+    """
+    Rewind the analytics loader to `from_offset` and load the log again.
+    To rebuild DuckDB from scratch, remove the DuckDB files and replay
+    from 0, while the log still starts there. After changing
+    ANALYTICS_SHARDS use cli.reshard instead.
+    """
+
+    check_retained(from_offset)
+    for shard in range(ANALYTICS_SHARDS):
+        conn = get_duck_conn(shard=shard)
+        try:
+            conn.execute(
+                "UPDATE sync_state SET log_offset = ? WHERE name = 'events'",
+                [from_offset],
+            )
+        except duckdb.CatalogException:
+            pass  # fresh file, the loader starts at 0
+        finally:
+            conn.close()
+
+    print(f"✅ {sync_events_to_duck()}")
+    print(f"✅ {publish_analytics_snapshots()}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3) or sys.argv[1] not in ("oltp", "analytics"):
+        print("Usage: python -m cli.replay_log <oltp|analytics> [from-offset]")
+        sys.exit(1)
+
+    from_offset = int(sys.argv[2]) if len(sys.argv) == 3 else 0
+    if sys.argv[1] == "oltp":
+        replay_oltp(from_offset)
+    else:
+        replay_analytics(from_offset)
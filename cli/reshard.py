@@ -0,0 +1,151 @@
+import os
+import shutil
+import time
+
+import duckdb
+
+from app.db.duck import (
+    ANALYTICS_SHARDS,
+    DUCKDB_PATH,
+    SNAPSHOT_DIR,
+    publish_snapshot,
+    shard_files,
+    shard_path,
+    stray_snapshot_dirs,
+)
+from app.tasks import _create_analytics_tables
+
+
+def shard_expr(column: str, shards: int) -> str:
+    """
+    SQL for app.db.duck.shard_for: the same multiplicative hash, taken
+    modulo 2**32 the way Python does, i.e. never negative.
+    """
+
+    return (
+        f"((CAST({column} AS HUGEINT) * 2654435761) % 4294967296 + 4294967296)"
+        f" % 4294967296 % {shards}"
+    )
+
+
+def _sync_state(files) -> tuple:
+    """
+    Return the lowest watermark and log offset over the old files, so
+    the loader resumes from the point every one of them had reached.
+    """
+
+    watermarks, offsets = [], []
+    for path in files:
+        conn = duckdb.connect(str(path), read_only=True)
+        try:
+            row = conn.execute(
+                "SELECT watermark, log_offset FROM sync_state WHERE name = 'events'"
+            ).fetchone()
+        except duckdb.CatalogException:
+            row = None
+        finally:
+            conn.close()
+        watermarks.append(row[0] if row else None)
+        offsets.append(row[1] if row and row[1] is not None else 0)
+
+    if None in watermarks:
+        return None, 0
+    return min(watermarks), min(offsets)
+
+
+def _build_shard(path, old_files, shard: int, watermark, log_offset: int) -> int:
+    conn = duckdb.connect(str(path))
+    try:
+        for i, old in enumerate(old_files):
+            conn.execute(f"ATTACH '{old}' AS old_{i} (READ_ONLY)")
+
+        columns = "user_id, occurred_at, event_type, properties, event_id"
+        conn.execute(
+            f"CREATE TABLE events AS SELECT {columns} FROM old_0.events LIMIT 0"
+        )
+        for i in range(len(old_files)):
+            conn.execute(
+                f"INSERT INTO events SELECT {columns} FROM old_{i}.events "
+                f"WHERE {shard_expr('user_id', ANALYTICS_SHARDS)} = {shard}"
+            )
+        for i in range(len(old_files)):
+            conn.execute(f"DETACH old_{i}")
+
+        # Creates sync_state and the event_id index, and backfills the
+        # hourly rollups from the redistributed events.
+        _create_analytics_tables(conn)
+        if watermark is not None:
+            conn.execute(
+                "INSERT INTO sync_state (name, watermark, log_offset, shards) "
+                "VALUES ('events', ?, ?, ?)",
+                [watermark, log_offset, ANALYTICS_SHARDS],
+            )
+        conn.execute("CHECKPOINT")
+        return conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def _drop_stray_snapshots():
+    for path in stray_snapshot_dirs():
+        if path != SNAPSHOT_DIR:
+            shutil.rmtree(path)
+            continue
+        # The single-shard layout keeps its snapshots in SNAPSHOT_DIR
+        # itself, next to the shard_N directories.
+        (path / "CURRENT").unlink()
+        for snapshot in path.glob("analytics-*.duckdb"):
+            snapshot.unlink()
+
+
+def reshard():
+    """
+    Redistribute the rows of the existing DuckDB files by
+    shard_for(user_id) into ANALYTICS_SHARDS new files, rebuild their
+    rollups and publish them.
+
+    Stop the Celery worker and beat first: the files must not be written
+    while they are rebuilt. The old files are kept in a
+    pre-reshard-<timestamp> directory next to them.
+    """
+
+    old_files = shard_files()
+    if not old_files:
+        print("✅ No DuckDB files to reshard.")
+        return
+
+    stamp = time.time_ns()
+    build_dir = DUCKDB_PATH.parent / f"reshard-{stamp}"
+    backup_dir = DUCKDB_PATH.parent / f"pre-reshard-{stamp}"
+    build_dir.mkdir()
+
+    watermark, log_offset = _sync_state(old_files)
+    rows = [
+        _build_shard(
+            build_dir / shard_path(shard).name, old_files, shard, watermark, log_offset
+        )
+        for shard in range(ANALYTICS_SHARDS)
+    ]
+
+    backup_dir.mkdir()
+    for old in old_files:
+        os.replace(old, backup_dir / old.name)
+        wal = old.with_name(old.name + ".wal")
+        if wal.exists():
+            os.replace(wal, backup_dir / wal.name)
+    for shard in range(ANALYTICS_SHARDS):
+        os.replace(build_dir / shard_path(shard).name, shard_path(shard))
+    build_dir.rmdir()
+
+    for shard in range(ANALYTICS_SHARDS):
+        publish_snapshot(shard)
+    _drop_stray_snapshots()
+
+    print(
+        f"✅ Resharded {len(old_files)} files into {ANALYTICS_SHARDS} "
+        f"({', '.join(map(str, rows))} events); old files kept in {backup_dir}."
+    )
+
+
+if __name__ == "__main__":
+    reshard()